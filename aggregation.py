@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+try:
+    from .candle_buffer import Candle
+except ImportError:
+    from candle_buffer import Candle
+
+# Roll-up timeframes (seconds), smallest first. "raw" means the saved candles as-is
+TIMEFRAMES = {
+    "15m": 15 * 60,
+    "1h": 60 * 60,
+    "4h": 4 * 60 * 60,
+    "1d": 24 * 60 * 60,
+}
+
+# Default cap on plotted / returned points
+MAX_POINTS = 240
+
+
+def aggregate(candles, timeframe):
+    """
+    Roll raw candles up into `timeframe` bars with a vectorized pandas resample
+    (first open, max high, min low, last close, summed volume). Empty buckets
+    (market closed) are dropped. Values stay integer units. Returns Candle tuples.
+    """
+    if timeframe == "raw" or not candles:
+        return list(candles)
+
+    symbol = candles[0].symbol
+    df = pd.DataFrame(
+        np.array([(c.open, c.high, c.low, c.close, c.volume) for c in candles], dtype=np.int64),
+        columns=["open", "high", "low", "close", "volume"],
+        index=pd.DatetimeIndex([c.timestamp for c in candles]),
+    )
+    df["id"] = np.array([c.id or 0 for c in candles], dtype=np.int64)
+
+    bars = df.resample(f"{TIMEFRAMES[timeframe]}s", label="left", closed="left").agg({
+        "open": "first",
+        "high": "max",
+        "low": "min",
+        "close": "last",
+        "volume": "sum",
+        "id": "max",
+    }).dropna(subset=["open"]).astype(np.int64)  # empty buckets made the columns float
+
+    return [
+        Candle(int(row.id), symbol, ts.to_pydatetime(), row.open, row.high, row.low, row.close, row.volume)
+        for ts, row in zip(bars.index, bars.itertuples(index=False))
+    ]
+
+
+def downsample(candles, max_points=MAX_POINTS):
+    """Pick the smallest timeframe that keeps the bar count <= max_points. Returns (bars, timeframe)"""
+    if len(candles) <= max_points:
+        return list(candles), "raw"
+    bars, timeframe = candles, "raw"
+    for timeframe in TIMEFRAMES:
+        bars = aggregate(candles, timeframe)
+        if len(bars) <= max_points:
+            break
+    return bars[-max_points:], timeframe
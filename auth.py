@@ -0,0 +1,113 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import deque
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class TokenSigner:
+    """
+    Stateless session tokens: "<user_id b64>.<expiry>.<HMAC-SHA256>".
+    Verifying is one HMAC, no database lookup. Without a configured secret a random
+    one is generated, so tokens stop working when the plugin restarts.
+    """
+
+    def __init__(self, secret=None, ttl=7 * 24 * 3600):
+        if isinstance(secret, str):
+            secret = secret.encode("utf-8")
+        self._secret = secret or secrets.token_bytes(32)
+        self.ttl = int(ttl)
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self._secret, payload.encode("ascii"), hashlib.sha256).digest())
+
+    def issue(self, user_id):
+        payload = f"{_b64encode(user_id.encode('utf-8'))}.{int(time.time()) + self.ttl}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token):
+        """Returns the token's user_id, or None if it is malformed, forged or expired"""
+        try:
+            user_part, expires, signature = token.split(".")
+            payload = f"{user_part}.{expires}"
+            # As bytes: compare_digest() raises TypeError on non-ASCII str
+            if not hmac.compare_digest(signature.encode("utf-8"), self._sign(payload).encode("ascii")):
+                return None
+            if int(expires) < time.time():
+                return None
+            return _b64decode(user_part).decode("utf-8")
+        except (ValueError, UnicodeError):
+            return None
+
+
+class LoginLimiter:
+    """
+    Sliding-window limit on failed logins per key (user id, client address). At most
+    `max_keys` keys are tracked, the least recently failed are forgotten first, so
+    failures under random user ids can't grow the table without bound.
+    """
+
+    def __init__(self, max_failures=5, window=300, max_keys=10_000):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_keys = max_keys
+        self._failures = {}  # key -> deque of failure times, oldest key first
+        self._swept = time.time()
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        attempts = self._failures.get(key)
+        if attempts is None:
+            return None
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+        if not attempts:
+            del self._failures[key]
+            return None
+        return attempts
+
+    def retry_after(self, *keys):
+        """Seconds until any of `keys` may try again, 0 if none is blocked"""
+        now = time.time()
+        wait = 0
+        with self._lock:
+            for key in keys:
+                attempts = self._recent(key, now)
+                if attempts and len(attempts) >= self.max_failures:
+                    wait = max(wait, attempts[0] + self.window - now)
+        return int(wait) + 1 if wait else 0
+
+    def fail(self, *keys):
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            for key in keys:
+                # Re-inserted so the key moves to the newest end
+                attempts = self._recent(key, now) or deque()
+                self._failures.pop(key, None)
+                attempts.append(now)
+                self._failures[key] = attempts
+
+    def _prune(self, now):
+        # Expired keys go once per window, or early when the table is full
+        if now - self._swept >= self.window or len(self._failures) >= self.max_keys:
+            for key in list(self._failures):
+                self._recent(key, now)
+            self._swept = now
+        while len(self._failures) >= self.max_keys:
+            del self._failures[next(iter(self._failures))]
+
+    def reset(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._failures.pop(key, None)
@@ -0,0 +1,57 @@
+"""
+Orders/sec through the matching engine: 1,000 concurrent submitters (asyncio tasks)
+on 8 symbols, 20 orders each, against a scratch database.
+
+    python bench/order_throughput.py [submitters] [orders_each]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import DB, OrderType
+from fixedpoint import to_qty
+from market import Market
+from matching import OrderRejected
+
+
+def main(submitters=1_000, orders_each=20):
+    db = DB(os.path.join(tempfile.mkdtemp(), "bench.db"))
+    market = Market(db, {"random_seed": 1})
+    market.is_open = True
+    engine = market.matcher
+    for future in [engine.ensure_user(f"b{i}") for i in range(submitters)]:
+        future.result()
+    commands, batches = engine.commands, engine.batches
+
+    async def client(i):
+        rnd = random.Random(i)
+        for n in range(orders_each):
+            # Buy, then sell what was bought, so every order can fill
+            if n % 2 == 0:
+                side, symbol = OrderType.BUY, rnd.choice(market.symbols)
+            else:
+                side = OrderType.SELL
+            try:
+                await asyncio.wrap_future(engine.place(f"b{i}", symbol, side, to_qty(0.1)))
+            except OrderRejected:
+                pass
+
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(*(client(i) for i in range(submitters)))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+    total = submitters * orders_each
+    batches = engine.batches - batches
+    print(f"{submitters} submitters, {total} orders: {total / elapsed:,.0f} orders/s "
+          f"({batches} batches, {(engine.commands - commands) / max(1, batches):.0f} commands/batch)")
+    market.stop()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,29 @@
+"""
+Ticks/sec of PriceEngine for 10, 1,000 and 100,000 symbols, per model (one core).
+
+    python bench/price_ticks.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from price_engine import MODELS, PriceEngine
+
+
+def main():
+    for n in (10, 1_000, 100_000):
+        for model in MODELS:
+            engine = PriceEngine(np.full(n, 100.0), model=model, correlation=0.3, seed=42)
+            steps = max(20, 2_000_000 // n)
+            start = time.perf_counter()
+            for _ in range(steps):
+                engine.step()
+            elapsed = time.perf_counter() - start
+            print(f"{n:>7} symbols  {model:<11} {steps / elapsed:>12,.0f} ticks/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Reply latency of other /zrb commands while 20 '/zrb history ZRB 30' charts render.
+
+The plugin runs outside AstrBot with a minimal stand-in for its plugin API, on a
+scratch database seeded with 30 days of ZRB candles (2,400). A '/zrb price' probe
+fires every 50 ms; its delay is measured from when it was due until it replied.
+
+    python bench/zrb_latency.py [concurrent_renders]
+"""
+import asyncio
+import importlib
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+from datetime import timedelta
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROBE_INTERVAL = 0.05
+CANDLES = 2400
+DAYS = 30
+
+
+def _install_astrbot_api():
+    """Just enough of astrbot.api to construct ZRBTrader"""
+    class Star:
+        def __init__(self, context):
+            self.context = context
+
+    event = types.ModuleType("astrbot.api.event")
+    event.filter = types.SimpleNamespace(command=lambda name: (lambda fn: fn))
+    event.AstrMessageEvent = event.MessageEventResult = object
+    star = types.ModuleType("astrbot.api.star")
+    star.Star, star.Context = Star, object
+    star.register = lambda *args: (lambda cls: cls)
+    api = types.ModuleType("astrbot.api")
+    api.logger = logging.getLogger("astrbot")
+    sys.modules.update({
+        "astrbot": types.ModuleType("astrbot"),
+        "astrbot.api": api,
+        "astrbot.api.event": event,
+        "astrbot.api.star": star,
+        "astrbot.api.all": types.ModuleType("astrbot.api.all"),
+    })
+
+
+class _Event:
+    def __init__(self, text):
+        self.message_str = text
+
+    def get_sender_id(self):
+        return "bench"
+
+    def get_sender_name(self):
+        return "bench"
+
+    def plain_result(self, text):
+        return ("text", text)
+
+    def image_result(self, path):
+        return ("image", path)
+
+
+def _load_plugin():
+    """
+    Import the plugin directory as package `zirunbi` through a symlink on sys.path:
+    web_server only has relative imports, the checkout's directory name may not be a
+    valid identifier, and spawned render workers must be able to import it too
+    """
+    root = tempfile.mkdtemp()
+    os.symlink(PLUGIN_DIR, os.path.join(root, "zirunbi"))
+    sys.path.insert(0, root)
+    return importlib.import_module("zirunbi.main")
+
+
+def _seed(db_path):
+    from zirunbi.database import DB, MarketHistory, get_china_time
+    from zirunbi.fixedpoint import to_price
+
+    db = DB(db_path)
+    now = get_china_time().replace(tzinfo=None)
+    step = timedelta(days=DAYS) / CANDLES
+    price = to_price(100)
+    session = db.get_session()
+    session.execute(MarketHistory.__table__.insert(), [{
+        "id": i + 1, "symbol": "ZRB", "timestamp": now - (CANDLES - i) * step,
+        "open": price, "high": price + 5000 + i % 7 * 1000, "low": price - 5000, "close": price + i % 5 * 1000,
+        "volume": 10_000,
+    } for i in range(CANDLES)])
+    session.commit()
+    session.close()
+    db.engine.dispose()
+
+
+async def _command(plugin, text):
+    return [result async for result in plugin.zrb(_Event(text))]
+
+
+async def _probe(plugin, until):
+    """Delays (s) of '/zrb price' probes fired every PROBE_INTERVAL until until() is true"""
+    loop = asyncio.get_running_loop()
+    delays = []
+    due = loop.time()
+    while not until():
+        await asyncio.sleep(max(0.0, due - loop.time()))
+        await _command(plugin, "zrb price")
+        delays.append(loop.time() - due)
+        due = max(due + PROBE_INTERVAL, loop.time())
+    return delays
+
+
+def _report(label, delays, elapsed):
+    delays = sorted(delays)
+    p95 = delays[int(len(delays) * 0.95) - 1] if len(delays) >= 20 else delays[-1]
+    print(f"{label:<22} {len(delays):>4} probe replies in {elapsed:5.1f} s, delay p50 "
+          f"{statistics.median(delays) * 1000:6.1f} ms, p95 {p95 * 1000:6.1f} ms, max {delays[-1] * 1000:6.1f} ms")
+
+
+async def main(renders=20):
+    _install_astrbot_api()
+    plugin_main = _load_plugin()
+    from zirunbi.database import DB
+
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    _seed(db_path)
+    # The plugin opens zirunbi.db next to main.py; point it at the scratch copy
+    plugin_main.DB = lambda _path: DB(db_path)
+    plugin = plugin_main.ZRBTrader(None, {
+        "time_source": "disabled", "web_port": 0, "chart_cache_mb": 0,
+        "max_pending_jobs": renders * 4,
+    })
+    try:
+        # Idle baseline, then the same probe while the renders run
+        start = time.perf_counter()
+        _report("idle", await _probe(plugin, lambda: time.perf_counter() - start > 2), 2)
+
+        start = time.perf_counter()
+        jobs = [asyncio.ensure_future(_command(plugin, f"zrb history ZRB {DAYS}")) for _ in range(renders)]
+        delays = await _probe(plugin, lambda: all(job.done() for job in jobs))
+        results = await asyncio.gather(*jobs)
+        elapsed = time.perf_counter() - start
+        _report(f"{renders} history renders", delays, elapsed)
+        images = sum(1 for replies in results for kind, _ in replies if kind == "image")
+        print(f"{images}/{renders} charts rendered")
+    finally:
+        await plugin.terminate()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(int(arg) for arg in sys.argv[1:2])))
@@ -0,0 +1,79 @@
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+# Same attribute names as MarketHistory, so plotting / API code accepts either
+Candle = namedtuple("Candle", "id symbol timestamp open high low close volume")
+
+
+class CandleRingBuffer:
+    """
+    Fixed-size ring of the newest candles of one symbol, stored column-wise in
+    NumPy arrays: 56 bytes per candle (id, timestamp, OHLCV in integer price units /
+    lots), e.g. 560KB for 10k candles.
+    """
+
+    def __init__(self, symbol, capacity):
+        self.symbol = symbol
+        self.capacity = max(1, int(capacity))
+        self._ids = np.zeros(self.capacity, dtype=np.int64)
+        self._ts = np.zeros(self.capacity, dtype="datetime64[us]")
+        self._ohlcv = np.zeros((self.capacity, 5), dtype=np.int64)
+        self._head = 0  # next write slot
+        self.size = 0
+        # True while the buffer holds the symbol's whole history (nothing evicted yet)
+        self.complete = True
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return self._ids.nbytes + self._ts.nbytes + self._ohlcv.nbytes
+
+    def append(self, candle_id, timestamp, open_, high, low, close, volume):
+        with self._lock:
+            if self.size == self.capacity:
+                self.complete = False
+            else:
+                self.size += 1
+            i = self._head
+            self._ids[i] = candle_id if candle_id is not None else 0
+            self._ts[i] = np.datetime64(timestamp.replace(tzinfo=None), "us")
+            self._ohlcv[i] = (open_, high, low, close, volume)
+            self._head = (i + 1) % self.capacity
+
+    def _order(self, n):
+        # Ring slots of the newest n candles, oldest first
+        start = (self._head - n) % self.capacity
+        return (np.arange(n) + start) % self.capacity
+
+    def _rows(self, idx):
+        ids = self._ids[idx].tolist()
+        ts = self._ts[idx].astype(object)
+        o, h, l, c, v = self._ohlcv[idx].T.tolist()
+        return [
+            Candle(ids[k], self.symbol, ts[k], o[k], h[k], l[k], c[k], v[k])
+            for k in range(len(idx))
+        ]
+
+    def recent(self, n):
+        """Newest n candles in chronological order, or None if the buffer can't cover n"""
+        with self._lock:
+            if n > self.size and not self.complete:
+                return None
+            return self._rows(self._order(min(n, self.size)))
+
+    def since(self, start_time):
+        """Candles with timestamp >= start_time, or None if older ones were evicted"""
+        start = np.datetime64(start_time.replace(tzinfo=None), "us")
+        with self._lock:
+            idx = self._order(self.size)
+            if not self.complete and (self.size == 0 or self._ts[idx[0]] > start):
+                return None
+            return self._rows(idx[self._ts[idx] >= start])
+
+    def last(self):
+        with self._lock:
+            if self.size == 0:
+                return None
+            return self._rows(self._order(1))[0]
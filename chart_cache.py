@@ -0,0 +1,104 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ChartCache:
+    """
+    LRU cache of rendered PNG files, bounded by total bytes on disk.
+    Keys are tuples like (kind, symbol, window, last_candle_id, ...), so a new candle
+    naturally produces a new key; invalidate() frees the stale files early.
+    A path returned by get() may still be on its way to the chat, so dropped files
+    are only deleted at the following invalidate(), one candle later.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, directory=None):
+        self.max_bytes = int(max_bytes)
+        self.directory = directory or tempfile.mkdtemp(prefix="zrb_charts_")
+        os.makedirs(self.directory, exist_ok=True)
+        self._entries = OrderedDict()  # key -> (path, size)
+        self._bytes = 0
+        self._retired = []  # paths dropped since the last invalidate(), deleted at the next
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path_for(self, name):
+        return os.path.join(self.directory, f"{name}.png")
+
+    def write_file(self, name, png):
+        """Write PNG bytes to a stable file name (atomic replace), returns the path"""
+        path = self._path_for(name)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, path)
+        return path
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and os.path.exists(entry[0]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                # File was removed behind our back
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, png):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        with self._lock:
+            # Same key, same file name: don't let a pending delete take the new file
+            if self._path_for(name) in self._retired:
+                self._retired.remove(self._path_for(name))
+        path = self.write_file(name, png)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries[key][1]
+            self._entries[key] = (path, len(png))
+            self._entries.move_to_end(key)
+            self._bytes += len(png)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+        return path
+
+    def _drop(self, key):
+        path, size = self._entries.pop(key)
+        self._bytes -= size
+        self._retired.append(path)
+
+    def invalidate(self, symbols=None):
+        """Drop cached charts for the given symbols (all if None)"""
+        with self._lock:
+            expired, self._retired = self._retired, []
+            stale = [k for k in self._entries if symbols is None or k[1] in symbols]
+            for key in stale:
+                self._drop(key)
+            for path in expired:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def close(self):
+        """Remove every cached file and the cache directory"""
+        self.invalidate()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,41 +1,23 @@
-import requests
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Enum, ForeignKey, Text, text
+from sqlalchemy import create_engine, event, Column, Integer, String, DateTime, Enum, ForeignKey, Text, Index, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 from datetime import datetime, timedelta, timezone
 import enum
+import os
+try:
+    from .timesync import current_offset
+    from .fixedpoint import CASH_SCALE, QTY_SCALE, PRICE_SCALE, INITIAL_BALANCE
+except ImportError:
+    from timesync import current_offset
+    from fixedpoint import CASH_SCALE, QTY_SCALE, PRICE_SCALE, INITIAL_BALANCE
 
 Base = declarative_base()
 
-# Global offset (in seconds) between system time and network time
-_time_offset = 0
-
-def sync_network_time():
-    global _time_offset
-    try:
-        # Using a reliable public HTTP endpoint
-        # Baidu is reliable in China
-        resp = requests.head("http://www.baidu.com", timeout=3)
-        date_str = resp.headers.get('Date')
-        if date_str:
-            # Parse RFC 2822 date
-            # e.g., "Wed, 21 Oct 2015 07:28:00 GMT"
-            network_time = datetime.strptime(date_str, '%a, %d %b %Y %H:%M:%S GMT')
-            network_time = network_time.replace(tzinfo=timezone.utc)
-            
-            system_time = datetime.utcnow().replace(tzinfo=timezone.utc)
-            
-            _time_offset = (network_time - system_time).total_seconds()
-            print(f"[Zirunbi] Time synced. Offset: {_time_offset:.2f}s")
-        else:
-            print("[Zirunbi] Failed to get Date header")
-    except Exception as e:
-        print(f"[Zirunbi] Time sync failed: {e}")
-
 # China Timezone helper with offset
 def get_china_time():
     utc_now = datetime.utcnow().replace(tzinfo=timezone.utc)
-    # Apply offset
-    utc_now = utc_now + timedelta(seconds=_time_offset)
+    # Apply offset (kept fresh by timesync.TimeSync in the background, no I/O here)
+    utc_now = utc_now + timedelta(seconds=current_offset())
     
     cn_tz = timezone(timedelta(hours=8))
     return utc_now.astimezone(cn_tz)
@@ -53,7 +35,8 @@ class User(Base):
     __tablename__ = 'users'
     user_id = Column(String, primary_key=True)
     password_hash = Column(String, nullable=True) # Web login password hash
-    balance = Column(Float, default=10000.0)
+    balance = Column(Integer, default=INITIAL_BALANCE) # Cash units, see fixedpoint
+    reserved_balance = Column(Integer, default=0) # Cash held by pending buy orders
     # Holdings will be in a separate table
     holdings = relationship("UserHolding", back_populates="user")
 
@@ -62,19 +45,30 @@ class UserHolding(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(String, ForeignKey('users.user_id'))
     symbol = Column(String)
-    amount = Column(Float, default=0.0)
+    amount = Column(Integer, default=0) # Lots
+    reserved_amount = Column(Integer, default=0) # Lots held by pending sell orders
+    cost_basis = Column(Integer, default=0) # Cash units paid for amount + reserved_amount, fees included
     user = relationship("User", back_populates="holdings")
 
+    __table_args__ = (
+        Index('ix_user_holdings_user_symbol', 'user_id', 'symbol', unique=True),
+    )
+
 class MarketHistory(Base):
     __tablename__ = 'market_history'
     id = Column(Integer, primary_key=True)
     symbol = Column(String)
     timestamp = Column(DateTime, default=get_china_time)
-    open = Column(Float)
-    high = Column(Float)
-    low = Column(Float)
-    close = Column(Float)
-    volume = Column(Float)
+    # Price units / lots
+    open = Column(Integer)
+    high = Column(Integer)
+    low = Column(Integer)
+    close = Column(Integer)
+    volume = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_market_history_symbol_timestamp', 'symbol', 'timestamp'),
+    )
 
 class MarketNews(Base):
     __tablename__ = 'market_news'
@@ -89,20 +83,142 @@ class Order(Base):
     user_id = Column(String)
     symbol = Column(String)
     order_type = Column(Enum(OrderType))
-    price = Column(Float, nullable=True) # None for market order
-    amount = Column(Float)
+    price = Column(Integer, nullable=True) # Price units, None for market order
+    amount = Column(Integer) # Lots
+    # Cash units (buy) or lots (sell) moved out of the free balance / holding at submission
+    reserved = Column(Integer, default=0)
     status = Column(Enum(OrderStatus), default=OrderStatus.PENDING)
     created_at = Column(DateTime, default=get_china_time)
 
+    __table_args__ = (
+        Index('ix_orders_status_symbol_price', 'status', 'symbol', 'price'),
+        Index('ix_orders_user_status', 'user_id', 'status'),
+    )
+
+class Fill(Base):
+    __tablename__ = 'fills'
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer)
+    user_id = Column(String)
+    symbol = Column(String)
+    side = Column(Enum(OrderType))
+    price = Column(Integer) # Execution price, price units
+    amount = Column(Integer) # Lots
+    fee = Column(Integer) # Cash units
+    # Sells: proceeds - fee - cost basis of the lots sold, cash units. Buys: 0
+    realized_pnl = Column(Integer, default=0)
+    timestamp = Column(DateTime, default=get_china_time)
+
+    __table_args__ = (
+        Index('ix_fills_user_timestamp', 'user_id', 'timestamp'),
+    )
+
+# Hot queries and the index each one must be served by (see DB.check_query_plans)
+HOT_QUERIES = {
+    "kline": (
+        "SELECT * FROM market_history WHERE symbol = 'ZRB' ORDER BY timestamp DESC LIMIT 60",
+        "ix_market_history_symbol_timestamp",
+    ),
+    "history": (
+        "SELECT * FROM market_history WHERE symbol = 'ZRB' AND timestamp >= '2024-01-01' ORDER BY timestamp",
+        "ix_market_history_symbol_timestamp",
+    ),
+    "pending_orders": (
+        "SELECT * FROM orders WHERE status = 'PENDING' AND symbol = 'ZRB' AND price >= 10000",
+        "ix_orders_status_symbol_price",
+    ),
+    "user_orders": (
+        "SELECT * FROM orders WHERE user_id = 'u' AND status = 'PENDING'",
+        "ix_orders_user_status",
+    ),
+    "holding": (
+        "SELECT * FROM user_holdings WHERE user_id = 'u' AND symbol = 'ZRB'",
+        "ix_user_holdings_user_symbol",
+    ),
+    # The daily report groups these rows by symbol and side, a sort of one user's day only
+    "user_fills": (
+        "SELECT * FROM fills WHERE user_id = 'u' AND timestamp >= '2024-01-01'",
+        "ix_fills_user_timestamp",
+    ),
+}
+
+# PRAGMA user_version of a fully migrated database:
+#   1: integer ledger, 2: holdings carry a cost basis
+SCHEMA_VERSION = 2
+
+# Columns stored as scaled integers since schema version 1, with their scale
+LEDGER_COLUMNS = {
+    "users": {"balance": CASH_SCALE},
+    "user_holdings": {"amount": QTY_SCALE},
+    "orders": {"price": PRICE_SCALE, "amount": QTY_SCALE},
+    "market_history": {
+        "open": PRICE_SCALE, "high": PRICE_SCALE, "low": PRICE_SCALE, "close": PRICE_SCALE,
+        "volume": QTY_SCALE,
+    },
+}
+
+# Applied to every pooled connection. The market thread, the bot handlers and the
+# web workers all write to the same file, so WAL lets readers run alongside the writer.
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA mmap_size=268435456",  # 256 MiB
+    "PRAGMA cache_size=-32768",    # 32 MiB
+    "PRAGMA temp_store=MEMORY",
+)
+
+def _setup_sqlite_engine(engine, read_only=False):
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_conn, record):
+        cursor = dbapi_conn.cursor()
+        if not read_only:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        if read_only:
+            cursor.execute("PRAGMA query_only=1")
+        cursor.close()
+
 class DB:
-    def __init__(self, db_path):
+    def __init__(self, db_path, pool_size=5, read_pool_size=10):
         if not db_path.startswith("sqlite"):
             db_path = f"sqlite:///{db_path}"
-        self.engine = create_engine(db_path)
+        url = make_url(db_path)
+        in_memory = url.database in (None, "", ":memory:")
+
+        if in_memory:
+            self.engine = create_engine(db_path)
+        else:
+            # One connection per thread at a time, shared across threads through the pool
+            self.engine = create_engine(
+                db_path,
+                connect_args={"check_same_thread": False, "timeout": 10},
+                pool_size=pool_size,
+                max_overflow=pool_size,
+                pool_timeout=30,
+            )
+        _setup_sqlite_engine(self.engine)
         Base.metadata.create_all(self.engine)
         
         # Auto-migration for schema updates
         self._migrate()
+        self.Session = sessionmaker(bind=self.engine)
+
+        # Query-heavy paths (charts, history, reports) use a separate read-only engine,
+        # WAL readers never block the writer and never see a half-written transaction
+        if in_memory:
+            self.read_engine = self.engine
+        else:
+            ro_url = url.set(database=f"file:{os.path.abspath(url.database)}?mode=ro", query={"uri": "true"})
+            self.read_engine = create_engine(
+                ro_url,
+                connect_args={"check_same_thread": False, "timeout": 10},
+                pool_size=read_pool_size,
+                max_overflow=read_pool_size,
+                pool_timeout=30,
+            )
+            _setup_sqlite_engine(self.read_engine, read_only=True)
+        self.ReadSession = sessionmaker(bind=self.read_engine)
     
     def _migrate(self):
         with self.engine.connect() as conn:
@@ -136,16 +252,127 @@ class DB:
                 except Exception as e:
                     print(f"Migration error (users.password_hash): {e}")
 
-        self.Session = sessionmaker(bind=self.engine)
+            # Reservation buckets (pending orders hold funds / quantity)
+            for table, column in (("users", "reserved_balance"), ("user_holdings", "reserved_amount"),
+                                  ("orders", "reserved"), ("user_holdings", "cost_basis")):
+                try:
+                    conn.execute(text(f"SELECT {column} FROM {table} LIMIT 1"))
+                except Exception:
+                    try:
+                        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER DEFAULT 0"))
+                        conn.commit()
+                    except Exception as e:
+                        print(f"Migration error ({table}.{column}): {e}")
+
+            # Merge duplicate holdings so the unique (user_id, symbol) index can be built
+            try:
+                dupes = conn.execute(text(
+                    "SELECT user_id, symbol, MIN(id), SUM(amount) FROM user_holdings "
+                    "GROUP BY user_id, symbol HAVING COUNT(*) > 1"
+                )).fetchall()
+                for user_id, symbol, keep_id, total in dupes:
+                    conn.execute(text("UPDATE user_holdings SET amount = :total WHERE id = :id"),
+                                 {"total": total, "id": keep_id})
+                    conn.execute(text("DELETE FROM user_holdings WHERE user_id = :u AND symbol = :s AND id != :id"),
+                                 {"u": user_id, "s": symbol, "id": keep_id})
+                if dupes:
+                    conn.commit()
+            except Exception as e:
+                print(f"Migration error (user_holdings duplicates): {e}")
+
+        try:
+            self._migrate_ledger()
+        except Exception as e:
+            # The integer code would misread a float ledger, so don't start on one
+            print(f"Migration error (integer ledger): {e}")
+            raise
+        try:
+            self._migrate_cost_basis()
+        except Exception as e:
+            print(f"Migration error (cost basis): {e}")
+
+        # create_all only builds indexes together with new tables, add them to existing ones
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    index.create(self.engine, checkfirst=True)
+                except Exception as e:
+                    print(f"Migration error (index {index.name}): {e}")
+
+    def _migrate_ledger(self):
+        """
+        Version 1: float balances / amounts / prices become integer units (see
+        fixedpoint). The old columns keep REAL affinity, which would turn stored
+        integers back into floats, so the tables are rebuilt from the models and the
+        rows copied over with the values scaled. One transaction, all or nothing.
+        """
+        with self.engine.connect() as conn:
+            if conn.execute(text("PRAGMA user_version")).scalar() >= 1:
+                return
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            declared = {row[1]: row[2].upper() for row in conn.execute(text("PRAGMA table_info(users)"))}
+            # A database created by this version already has INTEGER columns
+            if declared.get("balance", "INTEGER") != "INTEGER":
+                tables = [Base.metadata.tables[name] for name in LEDGER_COLUMNS]
+                for table in tables:
+                    for index in table.indexes:
+                        conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+                    conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {table.name}_old"))
+                for table in tables:
+                    table.create(conn)
+                    scales = LEDGER_COLUMNS[table.name]
+                    old_columns = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table.name}_old)"))}
+                    columns = [c.name for c in table.columns if c.name in old_columns]
+                    select = ", ".join(
+                        f"CAST(ROUND({c} * {scales[c]}) AS INTEGER)" if c in scales else c for c in columns
+                    )
+                    conn.execute(text(
+                        f"INSERT INTO {table.name} ({', '.join(columns)}) SELECT {select} FROM {table.name}_old"
+                    ))
+                for table in tables:
+                    conn.execute(text(f"DROP TABLE {table.name}_old"))
+                print("[Zirunbi] Migrated balances, holdings, orders and candles to integer units")
+            conn.execute(text("PRAGMA user_version = 1"))
+            conn.commit()
+
+    def _migrate_cost_basis(self):
+        """
+        Version 2: holdings bought before fills were recorded have no cost basis.
+        Start them at the last close, so realized P&L counts from the upgrade on.
+        """
+        with self.engine.connect() as conn:
+            # Only on top of version 1, never stamp over a step that didn't run
+            if conn.execute(text("PRAGMA user_version")).scalar() != 1:
+                return
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            conn.execute(text(
+                "UPDATE user_holdings SET cost_basis = COALESCE(("
+                "  SELECT CAST(ROUND((user_holdings.amount + user_holdings.reserved_amount) * h.close"
+                f"   / {PRICE_SCALE * QTY_SCALE // CASH_SCALE}.0) AS INTEGER)"
+                "  FROM market_history h WHERE h.symbol = user_holdings.symbol"
+                "  ORDER BY h.timestamp DESC LIMIT 1), 0) "
+                "WHERE COALESCE(cost_basis, 0) = 0 AND amount + reserved_amount > 0"
+            ))
+            conn.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+            conn.commit()
+
+    def check_query_plans(self):
+        """
+        Run EXPLAIN QUERY PLAN on every hot query and check it is served by its index.
+        Returns {name: (ok, plan_text)}.
+        """
+        results = {}
+        with self.engine.connect() as conn:
+            for name, (sql, index_name) in HOT_QUERIES.items():
+                rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).fetchall()
+                plan = "\n".join(str(row[-1]) for row in rows)
+                ok = index_name in plan and "USE TEMP B-TREE" not in plan
+                results[name] = (ok, plan)
+        return results
     
     def get_session(self):
         return self.Session()
-    
-    def get_or_create_user(self, user_id):
-        session = self.Session()
-        user = session.query(User).filter_by(user_id=str(user_id)).first()
-        if not user:
-            user = User(user_id=str(user_id))
-            session.add(user)
-            session.commit()
-        return user, session
+
+    def get_read_session(self):
+        """Session on the read-only engine, for queries that never write"""
+        return self.ReadSession()
@@ -0,0 +1,63 @@
+import asyncio
+import json
+import threading
+
+
+class EventHub:
+    """
+    Fan-out of market events to connected push clients (SSE).
+    publish() may be called from any thread; each event is JSON-encoded once and
+    queued to every subscriber on the server loop. A client whose queue is full
+    (slow reader) loses events instead of holding memory for everyone.
+    """
+
+    def __init__(self, max_queue=256):
+        self.max_queue = max_queue
+        self._loop = None
+        self._subscribers = {}  # queue -> user_id or None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def bind(self, loop):
+        """Attach to the event loop that serves the subscribers"""
+        self._loop = loop
+
+    def subscribe(self, user_id=None):
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers[queue] = user_id
+        return queue
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers.pop(queue, None)
+
+    @property
+    def client_count(self):
+        return len(self._subscribers)
+
+    @staticmethod
+    def encode(event, data):
+        """Format one SSE message"""
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+    def publish(self, event, data, user_id=None):
+        """Send to every subscriber, or only to those of `user_id` if given"""
+        loop = self._loop
+        if loop is None or loop.is_closed() or not self._subscribers:
+            return
+        message = self.encode(event, data)
+        try:
+            loop.call_soon_threadsafe(self._dispatch, message, user_id)
+        except RuntimeError:
+            # Loop shut down between the check and the call
+            pass
+
+    def _dispatch(self, message, user_id):
+        with self._lock:
+            targets = [q for q, uid in self._subscribers.items() if user_id is None or uid == user_id]
+        for queue in targets:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.dropped += 1
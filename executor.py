@@ -0,0 +1,63 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorBusy(Exception):
+    """Raised when the executor queue is full"""
+    pass
+
+
+class BoundedExecutor:
+    """
+    Thread pool for blocking work (SQLite sessions, chart rendering) called from
+    async handlers. At most `max_workers` jobs run and `max_pending` more may wait,
+    anything beyond that is rejected with ExecutorBusy instead of piling up.
+    """
+
+    def __init__(self, max_workers=4, max_pending=16, name="zrb-worker"):
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max(0, int(max_pending))
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_pending)
+        self._in_flight = 0
+        self._count_lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        """Jobs currently running or queued"""
+        return self._in_flight
+
+    def _release(self):
+        with self._count_lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit a job, returns a concurrent.futures.Future"""
+        if not self._slots.acquire(blocking=False):
+            raise ExecutorBusy()
+        with self._count_lock:
+            self._in_flight += 1
+
+        def job():
+            # Release the slot when the work itself is done, not when the caller
+            # stops waiting, so cancelled awaits can't overbook the pool
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._release()
+
+        try:
+            return self._pool.submit(job)
+        except Exception:
+            self._release()
+            raise
+
+    async def run(self, fn, *args, **kwargs):
+        """Run `fn` in the pool and await its result"""
+        return await asyncio.wrap_future(self.submit(functools.partial(fn, *args, **kwargs)))
+
+    def shutdown(self, wait=False):
+        self._pool.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,92 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# Ledger values are stored as integers in these units:
+#   cash:     1/100     (fen)
+#   quantity: 1/10000   (one lot)
+#   price:    1/10000 per unit of quantity
+CASH_SCALE = 100
+QTY_SCALE = 10_000
+PRICE_SCALE = 10_000
+
+# Trading fee in basis points of the trade value (0.1%)
+FEE_BPS = 10
+
+INITIAL_BALANCE = 10_000 * CASH_SCALE
+
+# Largest value an INTEGER column holds
+MAX_UNITS = 2 ** 63 - 1
+
+# price units * qty units -> cash units
+_VALUE_DIVISOR = PRICE_SCALE * QTY_SCALE // CASH_SCALE
+
+
+def _to_units(value, scale):
+    # Through Decimal(str()) so "0.1" or 0.1 become exactly 1000 lots, not 999
+    try:
+        units = int((Decimal(str(value)) * scale).to_integral_value(ROUND_HALF_UP))
+    except (InvalidOperation, OverflowError) as e:
+        raise ValueError(f"Not a finite number: {value!r}") from e
+    if abs(units) > MAX_UNITS:
+        raise ValueError(f"Out of range: {value!r}")
+    return units
+
+
+def _div_round(num, den):
+    """num / den rounded half away from zero, integers only"""
+    q, r = divmod(abs(num), den)
+    if 2 * r >= den:
+        q += 1
+    return q if num >= 0 else -q
+
+
+def to_cash(value):
+    return _to_units(value, CASH_SCALE)
+
+
+def to_qty(value):
+    return _to_units(value, QTY_SCALE)
+
+
+def to_price(value):
+    return None if value is None else _to_units(value, PRICE_SCALE)
+
+
+def from_cash(units):
+    return units / CASH_SCALE
+
+
+def from_qty(units):
+    return units / QTY_SCALE
+
+
+def from_price(units):
+    return None if units is None else units / PRICE_SCALE
+
+
+def trade_value(price, qty):
+    """Cash units of `qty` lots at `price` price units (for valuation, not settlement)"""
+    return _div_round(price * qty, _VALUE_DIVISOR)
+
+
+# Settlement rounds against the trader, so no trade costs less than its value or
+# pays out more. Rounded to nearest, a 1-lot buy of a coin priced under 50 was free.
+def buy_cost(price, qty):
+    """Cash units a buyer pays for `qty` lots at `price` price units, rounded up"""
+    return -(-price * qty // _VALUE_DIVISOR)
+
+
+def sell_proceeds(price, qty):
+    """Cash units a seller receives for `qty` lots at `price` price units, rounded down"""
+    return price * qty // _VALUE_DIVISOR
+
+
+def trade_fee(value):
+    """Fee in cash units for a trade worth `value` cash units, rounded up"""
+    return -(-value * FEE_BPS // 10_000)
+
+
+def prorate(total, part, whole):
+    """Share of `total` for `part` out of `whole` (e.g. cost basis of the lots sold)"""
+    if part >= whole:
+        return total
+    return _div_round(total * part, whole)
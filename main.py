@@ -4,19 +4,36 @@ from astrbot.api import logger
 from astrbot.api.all import *
 import os
 import io
-import tempfile
+import asyncio
 
 try:
-    from .database import DB, User, Order, OrderType, OrderStatus, MarketHistory, UserHolding, MarketNews, get_china_time
+    from .database import DB, User, Order, OrderType, OrderStatus, MarketNews, Fill, get_china_time
     from .market import Market
+    from .matching import OrderRejected
     from . import plotter
     from .web_server import WebServer, pwd_context
+    from .executor import BoundedExecutor, ExecutorBusy
+    from .renderer import RenderPool, RenderTimeout
+    from .chart_cache import ChartCache
+    from .aggregation import downsample
+    from .timesync import TimeSync, make_source
+    from .positions import mask_user_id
+    from .fixedpoint import INITIAL_BALANCE, to_qty, to_price, from_cash, from_qty, from_price, trade_value
 except ImportError:
-    from database import DB, User, Order, OrderType, OrderStatus, MarketHistory, UserHolding, MarketNews, get_china_time
+    from database import DB, User, Order, OrderType, OrderStatus, MarketNews, Fill, get_china_time
     from market import Market
+    from matching import OrderRejected
     import plotter
     from web_server import WebServer, pwd_context
-
+    from executor import BoundedExecutor, ExecutorBusy
+    from renderer import RenderPool, RenderTimeout
+    from chart_cache import ChartCache
+    from aggregation import downsample
+    from timesync import TimeSync, make_source
+    from positions import mask_user_id
+    from fixedpoint import INITIAL_BALANCE, to_qty, to_price, from_cash, from_qty, from_price, trade_value
+
+from sqlalchemy import func
 from datetime import datetime, timedelta
 
 @register("zrb_trader", "LumineStory", "模拟炒股插件", "1.1.0", "https://github.com/oyxning/astrbot-plugin-zirunbi")
@@ -26,40 +43,110 @@ class ZRBTrader(Star):
         self.config = config
         self.db_path = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'zirunbi.db')}"
         self.db = DB(self.db_path)
-        
+
+        # Network time offset, refreshed in the background so startup never waits on it
+        try:
+            time_source = make_source(config.get("time_source", "http"), config.get("time_server", ""))
+        except ValueError as e:
+            logger.warning(f"[Zirunbi] {e}, time sync disabled")
+            time_source = None
+        self.time_sync = TimeSync(time_source, interval=config.get("time_sync_interval", 3600))
+        self.time_sync.start()
+        for name, (ok, plan) in self.db.check_query_plans().items():
+            if not ok:
+                logger.warning(f"[Zirunbi] Query '{name}' is not using its index: {plan}")
+
+        # Blocking work (SQLite, plotting) runs here instead of on the bot event loop
+        self.executor = BoundedExecutor(
+            max_workers=config.get("worker_threads", 4),
+            max_pending=config.get("max_pending_jobs", 16)
+        )
+
         # Init plotter font
         font_path = config.get("font_path", "")
         plotter.init_font(font_path)
+
+        # Chart rendering runs in warm worker processes
+        self.render_pool = RenderPool(
+            processes=config.get("render_processes", 2),
+            max_renders=config.get("render_max_jobs", 100),
+            timeout=config.get("render_timeout", 30)
+        )
         
+        # Rendered K-line images, dropped when new candles are saved
+        self.chart_cache = ChartCache(max_bytes=int(config.get("chart_cache_mb", 32)) * 1024 * 1024)
+
         self.market = Market(self.db, config)
+        self.market.add_listener("candles", self.chart_cache.invalidate)
         self.market.start()
 
         # Start Web Server
         web_port = config.get("web_port", 8000)
-        self.web_server = WebServer(self.db, self.market, port=web_port)
-        self.web_server.run_in_background()
-        logger.info(f"[Zirunbi] Web server started on port {web_port}")
+        self.web_server = WebServer(self.db, self.market, port=web_port,
+                                    token_secret=config.get("web_token_secret", "") or None,
+                                    trusted_proxies=config.get("web_trusted_proxies", "127.0.0.1"))
+        web_mode = config.get("web_mode", "thread")
+        if web_mode == "embedded":
+            self.web_server.run_in_background()
+        else:
+            if web_mode != "thread":
+                logger.warning(f"[Zirunbi] Unknown web_mode '{web_mode}', using 'thread'")
+                web_mode = "thread"
+            self.web_server.run_in_thread()
+        logger.info(f"[Zirunbi] Web server started on port {web_port} ({web_mode})")
 
     async def terminate(self):
-        self.market.stop()
+        # Web requests first, so none is left waiting on a stopped matching engine
         if hasattr(self, 'web_server'):
             await self.web_server.stop()
+        self.market.stop()
+        self.time_sync.stop()
+        self.executor.shutdown()
+        self.render_pool.shutdown()
+        self.chart_cache.close()
         logger.info("[Zirunbi] Plugin terminated")
 
-    def _save_temp_image(self, buf):
-        """Helper to save BytesIO to temp file for image_result"""
+    def _save_temp_image(self, png, name):
+        """Helper to save PNG bytes for image_result, reusing one file per name"""
         try:
-            fd, path = tempfile.mkstemp(suffix=".png")
-            with os.fdopen(fd, 'wb') as f:
-                f.write(buf.getvalue())
-            return path
+            return self.chart_cache.write_file(name, png)
         except Exception as e:
             logger.error(f"Save temp image error: {e}")
             return None
 
+    def _render_image(self, kind, *args, cache_key=None, file_name=None, **kwargs):
+        """
+        Render through the pool and save the PNG. Returns (path, error message).
+        With cache_key the file is stored in the chart cache, otherwise under file_name.
+        """
+        try:
+            png = self.render_pool.render(kind, *args, **kwargs)
+        except RenderTimeout as e:
+            logger.warning(f"[Zirunbi] {e}")
+            return None, "绘图超时，请稍后再试"
+        if not png:
+            return None, "绘图失败"
+        if cache_key is not None:
+            try:
+                return self.chart_cache.put(cache_key, png), None
+            except OSError as e:
+                logger.error(f"Save chart cache error: {e}")
+                return None, "绘图保存失败"
+        img_path = self._save_temp_image(png, file_name or kind)
+        if not img_path:
+            return None, "绘图保存失败"
+        return img_path, None
+
     @filter.command("zrb")
     async def zrb(self, event: AstrMessageEvent):
         """模拟炒股指令"""
+        try:
+            async for result in self._zrb(event):
+                yield result
+        except ExecutorBusy:
+            yield event.plain_result("⏳ 系统繁忙，请稍后再试。")
+
+    async def _zrb(self, event: AstrMessageEvent):
         args = event.message_str.split()
         if len(args) < 2:
             help_text = """📈 孜然币模拟炒股系统 (v1.1.0)
@@ -81,6 +168,7 @@ class ZRBTrader(Star):
 👤 账户
 /zrb assets       我的资产
 /zrb today        今日盈亏
+/zrb rank         资产排行
 /zrb reset        重置账户
 
 ⚙️ 系统
@@ -118,13 +206,10 @@ class ZRBTrader(Star):
             # Ideally user should do this in private chat to avoid leaking password
             # But let's proceed.
             
-            user, session = self.db.get_or_create_user(user_id)
-            
-            # Hash password
-            pw_hash = pwd_context.hash(password)
-            user.password_hash = pw_hash
-            session.commit()
-            session.close()
+            # Hash password off the event loop; the matching engine (the only ledger
+            # writer) creates the user and stores the hash
+            pw_hash = await self.executor.run(pwd_context.hash, password)
+            await asyncio.wrap_future(self.market.matcher.ensure_user(user_id, pw_hash))
             
             # Construct URL
             web_url = self.config.get("web_public_url", "")
@@ -166,27 +251,26 @@ class ZRBTrader(Star):
             if not self.market.is_open:
                 yield event.plain_result(f"当前市场休市中，价格未变动。\n您可以查看截止休市前的K线。")
                 
-            session = self.db.get_session()
-            history = session.query(MarketHistory).filter_by(symbol=sym).order_by(MarketHistory.timestamp.desc()).limit(60).all()
-            session.close()
-            
-            # Reverse back to chronological order
-            history = history[::-1]
+            title_suffix = " (Closed)" if not self.market.is_open else ""
+            cache_key = ("kline", sym, 60, self.market.last_candle_ids.get(sym), title_suffix)
+            cached = self.chart_cache.get(cache_key)
+            if cached:
+                yield event.image_result(cached)
+                return
+
+            history = await self.executor.run(self.market.recent_candles, sym, 60)
+            history, _ = downsample(history)
             
             if not history:
                 yield event.plain_result(f"暂无 {sym} 历史数据")
                 return
                 
-            title_suffix = " (Closed)" if not self.market.is_open else ""
-            img_buf = plotter.plot_kline(history, title=f"{sym} Recent K-Line{title_suffix}")
-            if img_buf:
-                img_path = self._save_temp_image(img_buf)
-                if img_path:
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("绘图保存失败")
+            img_path, err = await self.executor.run(self._render_image, "kline", plotter.kline_payload(history),
+                                                    title=f"{sym} Recent K-Line{title_suffix}", cache_key=cache_key)
+            if img_path:
+                yield event.image_result(img_path)
             else:
-                yield event.plain_result("绘图失败")
+                yield event.plain_result(err)
 
         elif cmd == "history":
             # /zrb history <symbol> [days]
@@ -207,45 +291,47 @@ class ZRBTrader(Star):
                 except ValueError:
                     pass
             
-            session = self.db.get_session()
-            now = get_china_time()
-            start_date = now - timedelta(days=days)
-            
-            history = session.query(MarketHistory).filter(
-                MarketHistory.symbol == sym,
-                MarketHistory.timestamp >= start_date
-            ).order_by(MarketHistory.timestamp).all()
-            session.close()
+            # The window start slides with the clock, so the hour is part of the key
+            cache_key = ("history", sym, days, self.market.last_candle_ids.get(sym), get_china_time().strftime('%Y%m%d%H'))
+            cached = self.chart_cache.get(cache_key)
+            if cached:
+                yield event.image_result(cached)
+                return
+
+            start_date = get_china_time() - timedelta(days=days)
+            history = await self.executor.run(self.market.candles_since, sym, start_date)
             
             if not history:
                 yield event.plain_result(f"当日无数据")
                 return
             
-            # If too many points, resample might be needed, but for now just plot all (mpf handles reasonable amount)
-            # If > 500 points, maybe limit? 3 mins * 4 hours * days = 80 points/day. 3 days = 240. 30 days = 2400.
-            # mpf can handle 2400 but might be crowded. Let's limit display logic if needed later.
+            # 3 mins * 4 hours * days = 80 points/day, 30 days = 2400.
+            # Roll up into 15m/1h/4h/1d bars so the chart stays readable.
+            history, timeframe = await self.executor.run(downsample, history)
+            tf_label = "" if timeframe == "raw" else f", {timeframe}"
             
-            img_buf = plotter.plot_kline(history, title=f"{sym} History ({days} Days)")
-            if img_buf:
-                img_path = self._save_temp_image(img_buf)
-                if img_path:
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("绘图保存失败")
+            img_path, err = await self.executor.run(self._render_image, "kline", plotter.kline_payload(history),
+                                                    title=f"{sym} History ({days} Days{tf_label})", cache_key=cache_key)
+            if img_path:
+                yield event.image_result(img_path)
             else:
-                yield event.plain_result("绘图失败")
+                yield event.plain_result(err)
 
         elif cmd == "news":
             # /zrb news
-            session = self.db.get_session()
             # Only show news from today
             now = get_china_time()
             today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            
-            news_list = session.query(MarketNews).filter(
-                MarketNews.timestamp >= today_start
-            ).order_by(MarketNews.timestamp.desc()).limit(10).all()
-            session.close()
+
+            def load_news():
+                session = self.db.get_read_session()
+                rows = session.query(MarketNews).filter(
+                    MarketNews.timestamp >= today_start
+                ).order_by(MarketNews.timestamp.desc()).limit(10).all()
+                session.close()
+                return rows
+
+            news_list = await self.executor.run(load_news)
             
             if not news_list:
                 yield event.plain_result("今日暂无市场新闻。")
@@ -259,49 +345,43 @@ class ZRBTrader(Star):
 
         elif cmd == "today":
             # /zrb today
-            session = self.db.get_session()
             now = get_china_time()
             today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            
-            orders = session.query(Order).filter(
-                Order.user_id == user_id,
-                Order.status == OrderStatus.FILLED,
-                Order.created_at >= today_start
-            ).all()
-            session.close()
+
+            def load_fills():
+                # One aggregate over today's fills, a range scan of ix_fills_user_timestamp
+                session = self.db.get_read_session()
+                rows = session.query(
+                    Fill.symbol, Fill.side, func.count(Fill.id), func.sum(Fill.amount),
+                    func.sum(Fill.price * Fill.amount), func.sum(Fill.fee), func.sum(Fill.realized_pnl)
+                ).filter(
+                    Fill.user_id == user_id,
+                    Fill.timestamp >= today_start
+                ).group_by(Fill.symbol, Fill.side).order_by(Fill.symbol).all()
+                session.close()
+                return rows
+
+            totals = await self.executor.run(load_fills)
             
             msg = f"【今日交易日报】\n📅 {now.strftime('%Y-%m-%d')}\n\n"
             
-            if not orders:
+            if not totals:
                 msg += "今日无交易记录。\n"
             else:
-                buy_stats = {} # {symbol: {count, total_amt, total_cost}}
-                sell_stats = {}
-                
-                for o in orders:
-                    stats = buy_stats if o.order_type == OrderType.BUY else sell_stats
-                    if o.symbol not in stats:
-                        stats[o.symbol] = {'count': 0, 'amt': 0.0, 'cost': 0.0}
-                    
-                    stats[o.symbol]['count'] += 1
-                    stats[o.symbol]['amt'] += o.amount
-                    # For filled orders, price should be set. If None (market order), we approximate or skip cost calc if not recorded. 
-                    # Note: In real system, we should record execution price. Currently Order.price is limit price. 
-                    # Simplified: use Order.price if set, else approximate with current price (inaccurate).
-                    # Better: Market logic should update Order.price to execution price upon fill. 
-                    # Assuming Market logic updates price or we accept limit price as approximation.
-                    # Actually market.py doesn't update order.price to execution price for market orders. 
-                    # It uses current price. Let's just show amount.
-                    
                 msg += "💰 交易统计:\n"
-                if buy_stats:
-                    msg += "  [买入]\n"
-                    for sym, data in buy_stats.items():
-                        msg += f"  - {sym}: {data['amt']:.2f}个 ({data['count']}笔)\n"
-                if sell_stats:
-                    msg += "  [卖出]\n"
-                    for sym, data in sell_stats.items():
-                        msg += f"  - {sym}: {data['amt']:.2f}个 ({data['count']}笔)\n"
+                total_fee = total_pnl = 0
+                for side, label in ((OrderType.BUY, "买入"), (OrderType.SELL, "卖出")):
+                    rows = [row for row in totals if row[1] == side]
+                    if rows:
+                        msg += f"  [{label}]\n"
+                        for sym, _, count, amount, notional, fee, pnl in rows:
+                            # Volume-weighted average execution price
+                            avg_price = from_price(notional / amount) if amount else 0
+                            msg += f"  - {sym}: {from_qty(amount):.4f}个 均价 {avg_price:.2f} ({count}笔)\n"
+                            total_fee += fee
+                            total_pnl += pnl
+                msg += f"\n🧾 手续费: {from_cash(total_fee):.2f}\n"
+                msg += f"📊 已实现盈亏: {from_cash(total_pnl):+.2f}\n"
             
             msg += "\n📈 即时币价:\n"
             for sym, price in self.market.prices.items():
@@ -309,6 +389,23 @@ class ZRBTrader(Star):
                 
             yield event.plain_result(msg)
 
+        elif cmd == "rank":
+            # /zrb rank, read from the position cache without touching the database
+            positions = self.market.positions
+            top = positions.top(10)
+            if not top:
+                yield event.plain_result("暂无排行数据。")
+                return
+            initial = from_cash(INITIAL_BALANCE)
+            msg = "【总资产排行榜】\n"
+            for i, (uid, account) in enumerate(top, 1):
+                equity = from_cash(account["equity"])
+                msg += f"{i}. {mask_user_id(uid)}  {equity:.2f} ({equity / initial - 1:+.2%})\n"
+            my_rank = positions.rank(user_id)
+            if my_rank:
+                msg += f"\n你的排名: 第 {my_rank} 名 (共 {len(positions)} 人)"
+            yield event.plain_result(msg)
+
         elif cmd == "time":
             # /zrb time
             info = self.market.get_status_info()
@@ -319,6 +416,8 @@ class ZRBTrader(Star):
 
 📅 交易时段:
 {info['schedule']}"""
+            if info['holidays']:
+                msg += "\n🎌 近期休市: " + ", ".join(d.strftime('%m-%d') for d in info['holidays'])
             yield event.plain_result(msg)
 
         elif cmd == "info":
@@ -351,60 +450,24 @@ class ZRBTrader(Star):
 
         elif cmd == "change":
             # /zrb change
-            # Base prices are initial prices for simplicity in this simulation context, 
-            # or we could track "Open" price of the day.
-            # Let's use the 'Open' price of the current candle (which resets daily? No, current_candles in market.py are 3-min candles).
-            # We should get today's opening price.
-            # In market.py: self.prices is current price.
-            # We need to find Today's Open.
-            
-            session = self.db.get_session()
+            # Base price per symbol is today's first open, falling back to the last close
+            # before today. Market maintains it in memory (see Market.get_changes).
             now = get_china_time()
             today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
             
             msg = "【今日涨跌幅】\n"
             msg += f"基准时间: {today_start.strftime('%Y-%m-%d 00:00')}\n\n"
             
-            for sym in self.market.symbols:
-                # Get first history entry of today or last entry of yesterday as base
-                # Actually, let's just find the first history record >= today_start
-                # If no record today, find the last one before today.
-                
-                base_price = None
-                
-                # 1. Try to find the first record of today
-                first_today = session.query(MarketHistory).filter(
-                    MarketHistory.symbol == sym,
-                    MarketHistory.timestamp >= today_start
-                ).order_by(MarketHistory.timestamp.asc()).first()
-                
-                if first_today:
-                    base_price = first_today.open
-                else:
-                    # 2. If no record today, try last record before today
-                    last_prev = session.query(MarketHistory).filter(
-                        MarketHistory.symbol == sym,
-                        MarketHistory.timestamp < today_start
-                    ).order_by(MarketHistory.timestamp.desc()).first()
-                    
-                    if last_prev:
-                        base_price = last_prev.close
-                    else:
-                        # 3. Fallback to initial config price (hardcoded in market.py unfortunately, or we guess)
-                        # We can use current price as base if nothing else (change 0)
-                        base_price = self.market.prices.get(sym, 100.0)
-
-                current_price = self.market.prices.get(sym, 0.0)
+            for item in self.market.get_changes():
+                sym = item["symbol"]
+                current_price = item["price"]
+                base_price = item["base"]
                 
                 if base_price and base_price > 0:
-                    diff = current_price - base_price
-                    pct = (diff / base_price) * 100
+                    diff = item["diff"]
+                    pct = item["pct"]
                     
-                    # Formatting
-                    icon = "🔴" if diff > 0 else "fz" if diff < 0 else "⚪" # 🔴Up, 🟢Down (China standard: Red Up, Green Down)
-                    # Actually standard emoji: 📈 📉
-                    # But user asked for "mark how much it rose".
-                    # China stock color: Red=Rise, Green=Fall.
+                    # China stock color: Red=Rise, Green=Fall. Use neutral arrows here.
                     color_icon = "📈" if diff > 0 else "📉" if diff < 0 else "➖"
                     sign = "+" if diff > 0 else ""
                     
@@ -415,7 +478,6 @@ class ZRBTrader(Star):
                 
                 msg += "-"*20 + "\n"
             
-            session.close()
             yield event.plain_result(msg)
 
         elif cmd == "buy" or cmd == "sell":
@@ -430,111 +492,105 @@ class ZRBTrader(Star):
                 return
                 
             try:
-                amount = float(args[3])
-                price = float(args[4]) if len(args) > 4 else None
+                amount = to_qty(args[3])
+                price = to_price(args[4]) if len(args) > 4 else None
             except ValueError:
-                yield event.plain_result("数量或价格必须是数字")
+                yield event.plain_result("数量或价格必须是有效的数字")
                 return
 
             if amount <= 0:
                 yield event.plain_result("数量必须大于0")
                 return
+            if price is not None and price <= 0:
+                yield event.plain_result("价格必须大于0")
+                return
 
-            user, session = self.db.get_or_create_user(user_id)
-            
-            # Basic validation
-            if cmd == "buy":
-                est_price = price if price else self.market.prices[symbol]
-                cost = est_price * amount * 1.001 # +0.1% fee
-                if user.balance < cost:
-                    session.close()
-                    yield event.plain_result(f"余额不足。预估需要 {cost:.2f}, 当前余额 {user.balance:.2f}")
-                    return
-            else: # sell
-                # Check holding
-                holding = session.query(UserHolding).filter_by(user_id=user_id, symbol=symbol).first()
-                if not holding or holding.amount < amount:
-                    session.close()
-                    yield event.plain_result(f"持仓不足。当前持有 {holding.amount if holding else 0} {symbol}")
-                    return
-
-            order_type = OrderType.BUY if cmd == "buy" else OrderType.SELL
-            order = Order(
-                user_id=user_id,
-                symbol=symbol,
-                order_type=order_type,
-                price=price,
-                amount=amount
-            )
-            session.add(order)
-            session.commit()
-            order_id = order.id
-            session.close()
-            
-            # Trigger immediate match
-            self.market.match_single_order(order_id)
-            
-            # Check status
-            session = self.db.get_session()
-            updated_order = session.query(Order).get(order_id)
-            
-            if updated_order.status == OrderStatus.FILLED:
-                status_msg = "✅ 已成交"
-                desc = f"成交价格: {self.market.prices[symbol]:.2f}"
-            else:
-                if not self.market.is_open:
-                    status_msg = "🕒 已挂单 (休市中)"
-                    desc = "市场休市中，订单已挂起，将在开盘后自动撮合。"
+            async def place_order():
+                # Queued to the matching engine, which reserves the funds / holding and
+                # matches the order; nothing blocks here or on a worker thread
+                order_type = OrderType.BUY if cmd == "buy" else OrderType.SELL
+                try:
+                    order_id, status, exec_price = await asyncio.wrap_future(
+                        self.market.matcher.place(user_id, symbol, order_type, amount, price, create_user=True))
+                except OrderRejected as e:
+                    if e.reason == "balance":
+                        return f"余额不足。预估需要 {from_cash(e.need):.2f}, 当前可用 {from_cash(e.available):.2f}"
+                    return f"持仓不足。当前可卖 {from_qty(e.available)} {symbol}"
+                except Exception as e:
+                    logger.error(f"[Zirunbi] Order failed: {e}")
+                    return "下单失败，请稍后再试。"
+
+                if status == OrderStatus.FILLED:
+                    status_msg = "✅ 已成交"
+                    desc = f"成交价格: {exec_price:.2f}"
+                elif status == OrderStatus.CANCELLED:
+                    status_msg = "❌ 已撤销"
+                    desc = "成交时资金不足，订单已撤销。"
                 else:
-                    status_msg = "⏱️ 已挂单"
-                    desc = "订单已提交，等待市场价格到达指定价位。"
-            
-            session.close()
+                    if not self.market.is_open:
+                        status_msg = "🕒 已挂单 (休市中)"
+                        desc = "市场休市中，订单已挂起，将在开盘后自动撮合。"
+                    else:
+                        status_msg = "⏱️ 已挂单"
+                        desc = "订单已提交，等待市场价格到达指定价位。"
+                
+                return f"{cmd.upper()} 订单已提交。\n状态: {status_msg}\n说明: {desc}\n订单ID: {order_id}"
 
-            yield event.plain_result(f"{cmd.upper()} 订单已提交。\n状态: {status_msg}\n说明: {desc}\n订单ID: {order_id}")
+            yield event.plain_result(await place_order())
 
         elif cmd == "assets":
-            user, session = self.db.get_or_create_user(user_id)
-            holdings = session.query(UserHolding).filter_by(user_id=user_id).all()
+            # Cached ledgers are answered from memory, only a miss goes to the database
+            account = self.market.positions.peek(user_id) or await self.executor.run(self.market.positions.get, user_id)
+            if account is None:
+                await asyncio.wrap_future(self.market.matcher.ensure_user(user_id))
+                account = await self.executor.run(self.market.positions.get, user_id)
+            balance = from_cash(account["balance"])
+            reserved = from_cash(account["reserved_balance"])
             
             msg = f"【用户资产 - {user_name}】\n"
-            msg += f"可用资金: {user.balance:.2f}\n"
+            msg += f"可用资金: {balance:.2f}\n"
+            if reserved:
+                msg += f"挂单冻结: {reserved:.2f}\n"
             msg += "持仓:\n"
             
             holdings_dict = {}
             has_holdings = False
-            for h in holdings:
-                if h.amount > 0.0001:
-                    current_price = self.market.prices.get(h.symbol, 0)
-                    value = h.amount * current_price
-                    holdings_dict[h.symbol] = value
-                    msg += f"- {h.symbol}: {h.amount:.4f} (市值: {value:.2f})\n"
+            for sym, (amount, locked, cost) in sorted(account["positions"].items()):
+                total = amount + locked
+                if total > 0:
+                    value = from_cash(trade_value(self.market.price_units.get(sym, 0), total))
+                    holdings_dict[sym] = value
+                    msg += f"- {sym}: {from_qty(total):.4f} (市值: {value:.2f}, 均价: {from_cash(cost) / from_qty(total):.2f})"
+                    msg += f" [冻结 {from_qty(locked):.4f}]\n" if locked else "\n"
                     has_holdings = True
             
             if not has_holdings:
                 msg += "无\n"
-                
-            session.close()
+            msg += f"总资产: {from_cash(account['equity']):.2f}\n"
             
             # Plot
-            img_buf = plotter.plot_holdings_multi(user.balance, holdings_dict)
-            img_path = self._save_temp_image(img_buf)
+            img_path, _ = await self.executor.run(self._render_image, "holdings", balance + reserved, holdings_dict, file_name=f"holdings_{user_id}")
             if img_path:
                 yield event.image_result(img_path)
             
             yield event.plain_result(msg)
 
         elif cmd == "orders":
-            session = self.db.get_session()
-            orders = session.query(Order).filter_by(user_id=user_id, status=OrderStatus.PENDING).all()
-            session.close()
+            def load_pending():
+                session = self.db.get_read_session()
+                rows = session.query(Order).filter_by(user_id=user_id, status=OrderStatus.PENDING).all()
+                session.close()
+                return rows
+
+            orders = await self.executor.run(load_pending)
             
             if not orders:
                 yield event.plain_result("当前无挂单。")
             else:
                 msg = "【当前挂单】\n"
                 for o in orders:
-                    msg += f"ID:{o.id} {o.order_type.value} {o.symbol} {o.amount} @ {o.price}\n"
+                    price = f"{from_price(o.price):.4f}" if o.price is not None else "市价"
+                    msg += f"ID:{o.id} {o.order_type.value} {o.symbol} {from_qty(o.amount):.4f} @ {price}\n"
                 yield event.plain_result(msg)
 
         elif cmd == "cancel":
@@ -543,31 +599,23 @@ class ZRBTrader(Star):
                 return
             try:
                 oid = int(args[2])
-                session = self.db.get_session()
-                order = session.query(Order).filter_by(id=oid, user_id=user_id, status=OrderStatus.PENDING).first()
-                if order:
-                    order.status = OrderStatus.CANCELLED
-                    session.commit()
-                    msg = "订单已撤销。"
-                else:
-                    msg = "订单不存在或无法撤销。"
-                session.close()
-                yield event.plain_result(msg)
             except ValueError:
                 yield event.plain_result("订单ID必须是数字")
+                return
+
+            # Releases the order's reserved funds / holding
+            if await asyncio.wrap_future(self.market.matcher.cancel(user_id, oid)):
+                yield event.plain_result("订单已撤销。")
+            else:
+                yield event.plain_result("订单不存在或无法撤销。")
 
         elif cmd == "reset":
             if not is_admin():
                  yield event.plain_result("权限不足")
                  return
             # Admin only for now, or user self-reset? Let's allow user self-reset for fun
-            user, session = self.db.get_or_create_user(user_id)
-            user.balance = 10000.0
-            # Reset holdings
-            session.query(UserHolding).filter_by(user_id=user_id).delete()
-            session.query(Order).filter_by(user_id=user_id).delete()
-            session.commit()
-            session.close()
+            # Orders, holdings and balance, as one matching engine command
+            await asyncio.wrap_future(self.market.matcher.reset(user_id))
             yield event.plain_result("账户已重置。")
 
         elif cmd == "admin":
@@ -576,7 +624,7 @@ class ZRBTrader(Star):
                 return
             
             if len(args) < 3:
-                yield event.plain_result("Usage: /zrb admin [open|close]")
+                yield event.plain_result("Usage: /zrb admin [open|close|cache]")
                 return
                 
             sub = args[2]
@@ -586,5 +634,17 @@ class ZRBTrader(Star):
             elif sub == "close":
                 self.market.set_open(False)
                 yield event.plain_result("市场已休市。")
+            elif sub == "cache":
+                st = self.chart_cache.stats()
+                yield event.plain_result(
+                    f"【图表缓存】\n条目: {st['entries']}\n"
+                    f"占用: {st['bytes'] / 1024:.1f}KB / {st['max_bytes'] / 1024 / 1024:.0f}MB\n"
+                    f"命中: {st['hits']} 未命中: {st['misses']} (命中率 {st['hit_rate']:.1%})"
+                )
+                ps = self.market.positions.stats()
+                yield event.plain_result(
+                    f"【持仓缓存】\n用户: {ps['users']} / {ps['max_users']}\n"
+                    f"命中: {ps['hits']} 未命中: {ps['misses']} (命中率 {ps['hit_rate']:.1%})"
+                )
             else:
                 yield event.plain_result("未知指令")
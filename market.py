@@ -1,11 +1,35 @@
 import threading
 import time
 import random
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta, timezone
+from sqlalchemy import func
+import numpy as np
 try:
-    from .database import DB, User, UserHolding, Order, OrderType, OrderStatus, MarketHistory, MarketNews, get_china_time, sync_network_time
+    from .database import DB, MarketHistory, MarketNews, get_china_time
+    from .matching import MatchingEngine
+    from .positions import PositionCache
+    from .candle_buffer import CandleRingBuffer
+    from .aggregation import TIMEFRAMES, aggregate
+    from .persistence import PersistenceWriter
+    from .price_engine import PriceEngine
+    from .trading_calendar import TradingCalendar, DEFAULT_SESSIONS, DEFAULT_WEEKDAYS
+    from .fixedpoint import PRICE_SCALE, to_price, from_price
 except ImportError:
-    from database import DB, User, UserHolding, Order, OrderType, OrderStatus, MarketHistory, MarketNews, get_china_time, sync_network_time
+    from database import DB, MarketHistory, MarketNews, get_china_time
+    from matching import MatchingEngine
+    from positions import PositionCache
+    from candle_buffer import CandleRingBuffer
+    from aggregation import TIMEFRAMES, aggregate
+    from persistence import PersistenceWriter
+    from price_engine import PriceEngine
+    from trading_calendar import TradingCalendar, DEFAULT_SESSIONS, DEFAULT_WEEKDAYS
+    from fixedpoint import PRICE_SCALE, to_price, from_price
+
+# Plain column tuples for SQLite fallbacks, much cheaper than full ORM objects
+HISTORY_COLUMNS = (
+    MarketHistory.id, MarketHistory.symbol, MarketHistory.timestamp,
+    MarketHistory.open, MarketHistory.high, MarketHistory.low, MarketHistory.close, MarketHistory.volume
+)
 
 class Market:
     def __init__(self, db: DB, config: dict):
@@ -16,14 +40,12 @@ class Market:
         self.thread = None
         self.lock = threading.Lock()
         
-        # Sync network time
-        sync_network_time()
-        
         # Market State Logic
         # True = Open, False = Closed
         self.is_open = False 
         self.manual_override = None # None: Auto, True/False: Manual
         self.last_auto_state = None # To track transitions
+        self.calendar = self._build_calendar(config)
         
         # Define symbols
         self.symbols = ["ZRB", "STAR", "SHEEP", "XIANGZI", "MIAO", "QUNZHU", "IDEAL", "FEN"]
@@ -39,26 +61,72 @@ class Market:
             "IDEAL": 60.0,
             "FEN": 25.0
         }
+        # The same prices in integer price units (fixedpoint), used for matching and
+        # candles; `prices` is derived from these for display
+        self.price_units = {sym: to_price(price) for sym, price in self.prices.items()}
         
-        # Current candles per symbol
+        # Current candles per symbol (price units, volume in lots)
         self.current_candles = {}
         now = get_china_time()
         for sym in self.symbols:
             self.current_candles[sym] = {
-                "open": self.prices[sym],
-                "high": self.prices[sym],
-                "low": self.prices[sym],
-                "close": self.prices[sym],
-                "volume": 0.0,
+                "open": self.price_units[sym],
+                "high": self.price_units[sym],
+                "low": self.price_units[sym],
+                "close": self.price_units[sym],
+                "volume": 0,
                 "start_time": now
             }
         
+        # id of the newest committed MarketHistory row per symbol (chart cache keys).
+        # Ids are assigned here (the market is the only writer) so candles have them
+        # before they hit disk
+        self.last_candle_ids = {}
+        self._next_candle_id = 1
+        # Candles and news are written by a background thread, see _save_candles()
+        self.writer = PersistenceWriter(db)
+        # Newest N saved candles per symbol, recent-window reads are served from here
+        self.candle_buffer_size = int(config.get("candle_buffer_size", 2048))
+        self.candle_buffers = {sym: CandleRingBuffer(sym, self.candle_buffer_size) for sym in self.symbols}
+        # Event listeners, see add_listener()
+        self._listeners = {"prices": [], "candles": [], "fills": []}
+        # Change counters for conditional GETs: `version` moves on every price
+        # update / candle save, user_versions[user_id] when that user's balance
+        # or holdings change. Bumped after the change is committed.
+        self.version = 0
+        self.user_versions = {}
+
         # Load last prices from DB
         self._load_history()
-        
-        # Update interval
-        self.last_update_time = time.time()
-        self.update_interval = 180 # 3 minutes
+
+        # Prices tick every update_interval seconds (fractions allowed), candles close
+        # every candle_interval seconds independently of the tick rate
+        self.update_interval = max(0.05, float(config.get("update_interval", 60)))
+        self.candle_interval = max(1.0, float(config.get("candle_interval", 180)))
+        # `volatility` is per candle; each tick covers this fraction of a candle
+        self.tick_dt = self.update_interval / self.candle_interval
+        self._wake = threading.Event()
+
+        # Vectorized price model, advances all symbols per tick (continues from the loaded prices)
+        self.engine = self._build_price_engine([self.prices[sym] for sym in self.symbols],
+                                               self.volatility, config)
+
+        # Reference price for "today's change" per symbol:
+        # {sym: {"date": date, "price": price units, "source": "open" | "close"}}
+        self.session_refs = {}
+        self.session_date = None
+        self._load_session_refs()
+
+        # Ledgers of active users in memory, kept current by the matching engine and
+        # revalued every tick; asset views and the leaderboard read from here
+        self.positions = PositionCache(db, self.price_units, max_users=config.get("position_cache_size", 1024))
+        try:
+            self.positions.warm()
+        except Exception as e:
+            print(f"[Zirunbi] Error warming position cache: {e}")
+
+        # Owns the order book; every order / balance / holding write goes through it
+        self.matcher = MatchingEngine(self)
         
         # News Templates
         self.news_templates = [
@@ -91,11 +159,22 @@ class Market:
 
     def _load_history(self):
         try:
-            session = self.db.get_session()
+            session = self.db.get_read_session()
+            self._next_candle_id = (session.query(func.max(MarketHistory.id)).scalar() or 0) + 1
             for sym in self.symbols:
-                last = session.query(MarketHistory).filter_by(symbol=sym).order_by(MarketHistory.timestamp.desc()).first()
+                rows = session.query(MarketHistory).filter_by(symbol=sym).order_by(
+                    MarketHistory.timestamp.desc()).limit(self.candle_buffer_size).all()
+                buf = self.candle_buffers[sym]
+                for h in reversed(rows):
+                    buf.append(h.id, h.timestamp, h.open, h.high, h.low, h.close, h.volume)
+                # Fewer rows than capacity means the buffer holds the full history
+                buf.complete = len(rows) < self.candle_buffer_size
+
+                last = rows[0] if rows else None
                 if last:
-                    self.prices[sym] = last.close
+                    self.last_candle_ids[sym] = last.id
+                    self.price_units[sym] = last.close
+                    self.prices[sym] = from_price(last.close)
                     self.current_candles[sym]["open"] = last.close
                     self.current_candles[sym]["high"] = last.close
                     self.current_candles[sym]["low"] = last.close
@@ -104,108 +183,246 @@ class Market:
         except Exception as e:
             print(f"Error loading history: {e}")
 
+    def _load_session_refs(self):
+        """Today's first open per symbol, falling back to the last close before today"""
+        now = get_china_time()
+        today = now.date()
+        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        try:
+            for sym in self.symbols:
+                first_today = self.candles_since(sym, today_start)
+                if first_today:
+                    self.session_refs[sym] = {"date": today, "price": first_today[0].open, "source": "open"}
+                    continue
+                last_prev = self.recent_candles(sym, 1)
+                price = last_prev[-1].close if last_prev else self.price_units[sym]
+                self.session_refs[sym] = {"date": today, "price": price, "source": "close"}
+        except Exception as e:
+            print(f"Error loading session references: {e}")
+        self.session_date = today
+
+    def _roll_session(self, today):
+        """Day rollover: yesterday's last close becomes the reference until today's first candle"""
+        for sym in self.symbols:
+            last = self.candle_buffers[sym].last()
+            price = last.close if last else self.price_units[sym]
+            self.session_refs[sym] = {"date": today, "price": price, "source": "close"}
+        self.session_date = today
+
+    def get_changes(self):
+        """Change vs. the session reference for every symbol, computed from memory"""
+        changes = []
+        for sym in self.symbols:
+            price = self.prices.get(sym, 0.0)
+            ref = self.session_refs.get(sym)
+            base = from_price(ref["price"]) if ref else None
+            if base and base > 0:
+                diff = price - base
+                pct = diff / base * 100
+            else:
+                diff = pct = None
+            changes.append({"symbol": sym, "price": price, "base": base, "diff": diff, "pct": pct})
+        return changes
+
+    def recent_candles(self, symbol, n):
+        """Newest n saved candles (chronological), from memory when the ring buffer covers them"""
+        buf = self.candle_buffers.get(symbol)
+        rows = buf.recent(n) if buf else None
+        if rows is not None:
+            return rows
+        session = self.db.get_read_session()
+        rows = session.query(*HISTORY_COLUMNS).filter(MarketHistory.symbol == symbol).order_by(
+            MarketHistory.timestamp.desc()).limit(n).all()
+        session.close()
+        return rows[::-1]
+
+    def candles_since(self, symbol, start_time):
+        """Saved candles with timestamp >= start_time (chronological)"""
+        buf = self.candle_buffers.get(symbol)
+        rows = buf.since(start_time) if buf else None
+        if rows is not None:
+            return rows
+        session = self.db.get_read_session()
+        rows = session.query(*HISTORY_COLUMNS).filter(
+            MarketHistory.symbol == symbol,
+            MarketHistory.timestamp >= start_time
+        ).order_by(MarketHistory.timestamp).all()
+        session.close()
+        return rows
+
+    def get_candles(self, symbol, interval="raw", limit=100, since=None):
+        """
+        Newest `limit` bars of `interval` ("raw" or a key of aggregation.TIMEFRAMES).
+        With `since` (a bar timestamp the caller already has) the oldest `limit` bars
+        after it are returned instead, so a caller catching up pages forward without
+        gaps; for rolled-up intervals the bar starting at `since` is included again
+        since it may still have grown.
+        """
+        if since is not None:
+            since = since.replace(tzinfo=None)
+            if interval == "raw":
+                rows = self.candles_since(symbol, since + timedelta(microseconds=1))
+                return list(rows)[:limit]
+            tf = TIMEFRAMES[interval]
+            midnight = since.replace(hour=0, minute=0, second=0, microsecond=0)
+            start = since - timedelta(seconds=(since - midnight).total_seconds() % tf)
+            return aggregate(self.candles_since(symbol, start), interval)[:limit]
+        if interval == "raw":
+            return self.recent_candles(symbol, limit)
+        # Enough raw candles to fill `limit` bars, plus one partially covered bucket
+        per_bar = max(1, int(TIMEFRAMES[interval] // self.candle_interval))
+        raw = self.recent_candles(symbol, (limit + 1) * per_bar)
+        return aggregate(raw, interval)[-limit:]
+
+    def bump_user(self, user_id):
+        """Mark a user's ledger as changed"""
+        with self.lock:
+            self.user_versions[user_id] = self.user_versions.get(user_id, 0) + 1
+
+    def user_version(self, user_id):
+        return self.user_versions.get(user_id, 0)
+
+    def add_listener(self, kind, callback):
+        """
+        Register a callback, invoked from the thread that produced the event:
+          "prices":  callback({symbol: price}) after every price update
+          "candles": callback({symbol: Candle}) after closed candles are committed (writer thread)
+          "fills":   callback([fill dict, ...]) after filled orders are committed
+        """
+        self._listeners[kind].append(callback)
+
+    def _notify(self, kind, payload):
+        for callback in self._listeners[kind]:
+            try:
+                callback(payload)
+            except Exception as e:
+                print(f"Market listener error ({kind}): {e}")
+
     def start(self):
         if self.running:
             return
         self.running = True
+        self._wake.clear()
         self.thread = threading.Thread(target=self._loop, daemon=True)
         self.thread.start()
 
     def stop(self):
         self.running = False
+        self._wake.set()
         if self.thread:
             self.thread.join()
+        # Finish queued order commands, then write out queued candles / news
+        self.matcher.stop()
+        self.writer.stop()
 
     def set_open(self, is_open: bool):
         """Admin override"""
         self.manual_override = is_open
         self.is_open = is_open
+        self._wake.set()
 
-    def _check_market_hours(self):
-        """
-        Check if market should be open based on real China time.
-        Trading Hours:
-          09:30 - 11:30
-          13:00 - 15:00
-        Closed on Weekends (Saturday=5, Sunday=6)
-        """
-        now = get_china_time()
-        
-        # Weekends closed
-        if now.weekday() >= 5:
-            return False
-            
-        current_time = now.time()
-        
-        morning_start = datetime.strptime("09:30", "%H:%M").time()
-        morning_end = datetime.strptime("11:30", "%H:%M").time()
-        afternoon_start = datetime.strptime("13:00", "%H:%M").time()
-        afternoon_end = datetime.strptime("15:00", "%H:%M").time()
-        
-        is_trading_time = (morning_start <= current_time <= morning_end) or \
-                          (afternoon_start <= current_time <= afternoon_end)
-                          
-        return is_trading_time
+    @staticmethod
+    def _build_calendar(config):
+        """Trading calendar from config, the default A-share schedule if it is invalid"""
+        try:
+            return TradingCalendar(
+                sessions=config.get("trading_sessions") or DEFAULT_SESSIONS,
+                weekdays=config.get("trading_days") or DEFAULT_WEEKDAYS,
+                holidays=config.get("holidays") or ()
+            )
+        except (ValueError, TypeError) as e:
+            print(f"[Zirunbi] Invalid trading calendar config ({e}), using the default schedule")
+            return TradingCalendar()
+
+    @staticmethod
+    def _build_price_engine(prices, volatility, config):
+        """Price engine from config, uncorrelated GBM if the model or correlation is invalid"""
+        seed = int(config.get("random_seed", 0)) or None
+        try:
+            return PriceEngine(
+                prices,
+                volatility=volatility,
+                model=config.get("price_model", "gbm"),
+                correlation=float(config.get("price_correlation", 0.0)) or None,
+                seed=seed
+            )
+        except (ValueError, TypeError) as e:
+            print(f"[Zirunbi] Invalid price model config ({e}), using uncorrelated gbm")
+            return PriceEngine(prices, volatility=volatility, seed=seed)
+
+    def _schedule_wait(self, now):
+        """Seconds until the open/close state or the trading day can change"""
+        transition, _ = self.calendar.next_transition(now)
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        target = min(transition, midnight) if transition else midnight
+        # Re-check hourly anyway, the synced clock offset may move
+        return min(max(0.0, (target - now).total_seconds()), 3600.0)
 
     def get_status_info(self):
         now = get_china_time()
-        is_weekend = now.weekday() >= 5
-        
-        # Schedule definition
-        morning_start = now.replace(hour=9, minute=30, second=0, microsecond=0)
-        morning_end = now.replace(hour=11, minute=30, second=0, microsecond=0)
-        afternoon_start = now.replace(hour=13, minute=0, second=0, microsecond=0)
-        afternoon_end = now.replace(hour=15, minute=0, second=0, microsecond=0)
-        
-        status_str = ""
-        countdown_str = ""
-        
-        if is_weekend:
-            status_str = "周末休市"
-            # Calculate days until Monday 9:30
-            days_until_mon = 7 - now.weekday()
-            next_open = morning_start + timedelta(days=days_until_mon)
-            delta = next_open - now
-            countdown_str = f"距离开市还有: {delta.days}天 {delta.seconds//3600}小时 {(delta.seconds//60)%60}分"
+        cal = self.calendar
+        sessions = cal.day_sessions(now.date())
+        next_change, _ = cal.next_transition(now)
+
+        def until(target, with_days=False):
+            if target is None:
+                return "暂无开市安排"
+            delta = target - now
+            text = f"{delta.seconds//3600}小时 {(delta.seconds//60)%60}分"
+            return f"{delta.days}天 {text}" if with_days else text
+
+        if len(sessions) == 2:
+            names = ["早盘", "午盘"]
         else:
-            if now < morning_start:
-                status_str = "早盘未开"
-                delta = morning_start - now
-                countdown_str = f"距离早盘开市: {delta.seconds//3600}小时 {(delta.seconds//60)%60}分"
-            elif morning_start <= now <= morning_end:
-                status_str = "早盘交易中"
-                delta = morning_end - now
-                countdown_str = f"距离午间休市: {delta.seconds//3600}小时 {(delta.seconds//60)%60}分"
-            elif morning_end < now < afternoon_start:
-                status_str = "午间休市"
-                delta = afternoon_start - now
-                countdown_str = f"距离午盘开市: {delta.seconds//3600}小时 {(delta.seconds//60)%60}分"
-            elif afternoon_start <= now <= afternoon_end:
-                status_str = "午盘交易中"
-                delta = afternoon_end - now
-                countdown_str = f"距离今日收盘: {delta.seconds//3600}小时 {(delta.seconds//60)%60}分"
-            else:
-                status_str = "今日已收盘"
-                # Next day 9:30
-                next_open = morning_start + timedelta(days=1)
-                # Skip weekend if Friday
-                if now.weekday() == 4: # Friday
-                    next_open += timedelta(days=2)
-                delta = next_open - now
-                countdown_str = f"距离下个交易日开市: {delta.days}天 {delta.seconds//3600}小时 {(delta.seconds//60)%60}分"
-                
+            names = [f"第{i + 1}节" for i in range(len(sessions))]
+
+        if not sessions:
+            status_str = "周末休市" if now.isoweekday() not in cal.weekdays else "节假日休市"
+            countdown_str = f"距离开市还有: {until(next_change, True)}"
+        elif now < sessions[0][0]:
+            status_str = f"{names[0]}未开"
+            countdown_str = f"距离{names[0]}开市: {until(sessions[0][0])}"
+        elif now >= sessions[-1][1]:
+            status_str = "今日已收盘"
+            countdown_str = f"距离下个交易日开市: {until(next_change, True)}"
+        else:
+            status_str = countdown_str = ""
+            for i, (start, end) in enumerate(sessions):
+                if start <= now < end:
+                    status_str = f"{names[i]}交易中"
+                    last = i == len(sessions) - 1
+                    label = "今日收盘" if last else ("午间休市" if len(sessions) == 2 else "本节休市")
+                    countdown_str = f"距离{label}: {until(end)}"
+                    break
+                if i + 1 < len(sessions) and end <= now < sessions[i + 1][0]:
+                    status_str = "午间休市" if len(sessions) == 2 else "盘间休市"
+                    countdown_str = f"距离{names[i + 1]}开市: {until(sessions[i + 1][0])}"
+                    break
+
         return {
             "now_str": now.strftime("%Y-%m-%d %H:%M:%S (UTC+8)"),
             "status": status_str,
             "countdown": countdown_str,
-            "schedule": "周一至周五 09:30-11:30, 13:00-15:00"
+            "schedule": cal.describe(),
+            "holidays": sorted(d for d in cal.holidays if d >= now.date())[:5],
+            "next_transition": next_change
         }
 
     def _loop(self):
+        # Deadlines on the monotonic clock; the loop sleeps until the nearest one
+        next_tick = time.monotonic()
+        next_candle = next_tick + self.candle_interval
         while self.running:
             try:
+                # set_open() / stop() wake us early; clear first so no wake-up is lost
+                self._wake.clear()
+                now_cn = get_china_time()
+                today = now_cn.date()
+                if today != self.session_date:
+                    self._roll_session(today)
+
                 # --- Auto Open/Close Logic ---
-                should_be_open = self._check_market_hours()
+                should_be_open = self.calendar.is_open(now_cn)
                 
                 # If this is the first run, initialize last_auto_state
                 if self.last_auto_state is None:
@@ -225,7 +442,7 @@ class Market:
                     
                     # If market just opened, trigger match orders immediately
                     if self.is_open:
-                        self.match_orders()
+                        self.matcher.match()
                 
                 # Apply manual override if active, otherwise follow auto schedule
                 if self.manual_override is not None:
@@ -233,22 +450,29 @@ class Market:
                 # else: self.is_open is already set by transitions or init
                 
                 if not self.is_open:
-                    time.sleep(1)
+                    # Nothing to do until the next open (or an admin opens the market)
+                    self._wake.wait(self._schedule_wait(now_cn))
                     continue
 
-                now_ts = time.time()
-                if now_ts - self.last_update_time >= self.update_interval:
-                    self.last_update_time = now_ts
+                now = time.monotonic()
+                if now >= next_tick:
                     self._update_prices()
+                    # Match resting orders at the new prices (queued, the engine thread runs it)
+                    self.matcher.match()
+                    # Skip ticks missed while closed or overloaded instead of bursting
+                    next_tick = max(next_tick + self.update_interval, now)
+                if now >= next_candle:
                     self._save_candles()
                     self._generate_news() # Generate news
-                    # Trigger match orders after price update (for Limit orders)
-                    self.match_orders()
-                
-                time.sleep(1)
+                    next_candle = max(next_candle + self.candle_interval, now)
+
+                # Wake at the next tick / candle deadline or schedule change, whichever is first
+                delay = min(next_tick, next_candle) - time.monotonic()
+                if delay > 0:
+                    self._wake.wait(min(delay, self._schedule_wait(get_china_time())))
             except Exception as e:
                 print(f"Market loop error: {e}")
-                time.sleep(5)
+                self._wake.wait(5)
 
     def _generate_news(self):
         # 30% chance to generate news per update cycle
@@ -258,137 +482,86 @@ class Market:
                 template = random.choice(self.news_templates)
                 content = template.format(symbol=symbol)
                 
-                session = self.db.get_session()
-                news = MarketNews(
-                    title=f"关于 {symbol} 的市场快讯",
-                    content=content
-                )
-                session.add(news)
-                session.commit()
-                session.close()
+                self.writer.submit(MarketNews, [{
+                    "timestamp": get_china_time(),
+                    "title": f"关于 {symbol} 的市场快讯",
+                    "content": content
+                }])
             except Exception as e:
                 print(f"Generate news error: {e}")
 
     def _update_prices(self):
+        # Only the market loop advances the engine, the lock guards the dicts readers see
+        new_prices = np.rint(self.engine.step(self.tick_dt) * PRICE_SCALE).astype(np.int64).tolist()
         with self.lock:
-            for sym in self.symbols:
-                price = self.prices[sym]
-                change_pct = random.gauss(0, self.volatility)
-                price *= (1 + change_pct)
-                price = max(0.01, price)
-                self.prices[sym] = price
+            for sym, price in zip(self.symbols, new_prices):
+                self.price_units[sym] = price
+                self.prices[sym] = price / PRICE_SCALE
                 
                 # Update candle
                 candle = self.current_candles[sym]
                 candle["high"] = max(candle["high"], price)
                 candle["low"] = min(candle["low"], price)
                 candle["close"] = price
+            self.version += 1
+            prices = dict(self.prices)
+            units = dict(self.price_units)
+        self.positions.mark(units)
+        self._notify("prices", prices)
 
     def _save_candles(self):
+        """
+        Close the current candles. Under the lock only the in-memory snapshot and
+        reset happen; the rows go to the background writer for a batched insert.
+        """
         with self.lock:
-            session = self.db.get_session()
             now = get_china_time()
+            rows = []
             for sym in self.symbols:
                 candle = self.current_candles[sym]
-                history = MarketHistory(
-                    symbol=sym,
-                    timestamp=candle["start_time"], # Use the start time of the period
-                    open=candle["open"],
-                    high=candle["high"],
-                    low=candle["low"],
-                    close=candle["close"],
-                    volume=candle["volume"]
-                )
-                session.add(history)
+                rows.append({
+                    "id": self._next_candle_id,
+                    "symbol": sym,
+                    "timestamp": candle["start_time"], # Use the start time of the period
+                    "open": candle["open"],
+                    "high": candle["high"],
+                    "low": candle["low"],
+                    "close": candle["close"],
+                    "volume": candle["volume"],
+                })
+                self._next_candle_id += 1
                 
                 # Reset candle for next period
                 self.current_candles[sym] = {
-                    "open": self.prices[sym],
-                    "high": self.prices[sym],
-                    "low": self.prices[sym],
-                    "close": self.prices[sym],
-                    "volume": 0.0,
+                    "open": self.price_units[sym],
+                    "high": self.price_units[sym],
+                    "low": self.price_units[sym],
+                    "close": self.price_units[sym],
+                    "volume": 0,
                     "start_time": now
                 }
-            session.commit()
-            session.close()
+            for row in rows:
+                sym = row["symbol"]
+                self.candle_buffers[sym].append(row["id"], row["timestamp"], row["open"], row["high"],
+                                                row["low"], row["close"], row["volume"])
+                # The first candle of the day sets the reference to its open
+                ref = self.session_refs.get(sym)
+                day = row["timestamp"].date()
+                if day == self.session_date and (not ref or ref["date"] != day or ref["source"] != "open"):
+                    self.session_refs[sym] = {"date": day, "price": row["open"], "source": "open"}
+            self.version += 1
+        candles = {row["symbol"]: self.candle_buffers[row["symbol"]].last() for row in rows}
+        self.writer.submit(MarketHistory, rows, on_commit=lambda: self._candles_committed(rows, candles))
 
-    def match_single_order(self, order_id):
-        """Try to match a specific order immediately (for immediate feedback)"""
-        session = self.db.get_session()
-        order = session.query(Order).filter_by(id=order_id, status=OrderStatus.PENDING).first()
-        if order:
-            self._process_order(session, order)
-        session.commit()
-        session.close()
-
-    def match_orders(self):
-        """Match all pending orders"""
-        session = self.db.get_session()
-        orders = session.query(Order).filter(Order.status == OrderStatus.PENDING).all()
-        for order in orders:
-            self._process_order(session, order)
-        session.commit()
-        session.close()
+    def _candles_committed(self, rows, candles):
+        # Writer thread. Readers falling back to SQLite see these rows from here on
+        for row in rows:
+            self.last_candle_ids[row["symbol"]] = row["id"]
+        self._notify("candles", candles)
 
-    def _process_order(self, session, order):
-        if not self.is_open:
-            return
-
-        current_price = self.prices.get(order.symbol)
-        if not current_price:
-            return
-
-        execute = False
-        exec_price = current_price
-        
-        if order.price is None: # Market order
-            execute = True
-        elif order.order_type == OrderType.BUY and current_price <= order.price:
-            execute = True
-        elif order.order_type == OrderType.SELL and current_price >= order.price:
-            execute = True
-        
-        if execute:
-            self._execute_order(session, order, exec_price)
-
-    def _execute_order(self, session, order, exec_price):
-        user = session.query(User).filter_by(user_id=order.user_id).first()
-        if not user:
-            return
-            
-        fee_rate = 0.001
-        total_cost = exec_price * order.amount
-        fee = total_cost * fee_rate
-        
-        if order.order_type == OrderType.BUY:
-            cost_with_fee = total_cost + fee
-            if user.balance >= cost_with_fee:
-                user.balance -= cost_with_fee
-                # Update holding
-                holding = session.query(UserHolding).filter_by(user_id=user.user_id, symbol=order.symbol).first()
-                if not holding:
-                    holding = UserHolding(user_id=user.user_id, symbol=order.symbol, amount=0.0)
-                    session.add(holding)
-                holding.amount += order.amount
-                
-                order.status = OrderStatus.FILLED
-                with self.lock:
-                    if order.symbol in self.current_candles:
-                        self.current_candles[order.symbol]["volume"] += order.amount
-            else:
-                order.status = OrderStatus.CANCELLED # Cancel if insufficient funds at execution
-        
-        elif order.order_type == OrderType.SELL:
-            holding = session.query(UserHolding).filter_by(user_id=user.user_id, symbol=order.symbol).first()
-            if holding and holding.amount >= order.amount:
-                holding.amount -= order.amount
-                revenue = total_cost - fee
-                user.balance += revenue
-                
-                order.status = OrderStatus.FILLED
-                with self.lock:
-                     if order.symbol in self.current_candles:
-                        self.current_candles[order.symbol]["volume"] += order.amount
-            else:
-                order.status = OrderStatus.CANCELLED
+    def add_volume(self, volumes):
+        """Add traded lots ({symbol: lots}) to the current candles"""
+        with self.lock:
+            for sym, amount in volumes.items():
+                if sym in self.current_candles:
+                    self.current_candles[sym]["volume"] += amount
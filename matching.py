@@ -0,0 +1,572 @@
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from sqlalchemy import bindparam, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+try:
+    from .database import User, UserHolding, Order, OrderType, OrderStatus, Fill, get_china_time
+    from .orderbook import OrderBook
+    from .fixedpoint import INITIAL_BALANCE, MAX_UNITS, from_price, from_qty, from_cash, buy_cost, sell_proceeds, trade_fee, prorate
+except ImportError:
+    from database import User, UserHolding, Order, OrderType, OrderStatus, Fill, get_china_time
+    from orderbook import OrderBook
+    from fixedpoint import INITIAL_BALANCE, MAX_UNITS, from_price, from_qty, from_cash, buy_cost, sell_proceeds, trade_fee, prorate
+
+ORDER_COLUMNS = (
+    Order.id, Order.user_id, Order.symbol, Order.order_type, Order.price, Order.amount, Order.reserved
+)
+
+_users = User.__table__
+_holdings = UserHolding.__table__
+_orders = Order.__table__
+_fills = Fill.__table__
+
+# The per-order reservation runs once per submission, as plain SQL: building and
+# compiling a Core statement each time cost several times the UPDATE itself
+_RESERVE_CASH = ("UPDATE users SET balance = balance - ?, reserved_balance = reserved_balance + ? "
+                 "WHERE user_id = ? AND balance >= ?")
+_RESERVE_QTY = ("UPDATE user_holdings SET amount = amount - ?, reserved_amount = reserved_amount + ? "
+                "WHERE user_id = ? AND symbol = ? AND amount >= ?")
+_BALANCE = _users.select().with_only_columns(_users.c.balance).where(_users.c.user_id == bindparam("uid"))
+_HOLDING = _holdings.select().with_only_columns(_holdings.c.amount).where(
+    _holdings.c.user_id == bindparam("uid"), _holdings.c.symbol == bindparam("sym"))
+
+
+@contextmanager
+def _savepoint(conn):
+    """
+    SAVEPOINT around one engine command, as plain SQL: session.begin_nested() costs
+    more than most commands. The engine runs Core statements only, so no ORM state
+    needs expiring on a rollback.
+    """
+    conn.exec_driver_sql("SAVEPOINT zrb_command")
+    try:
+        yield
+    except BaseException:
+        conn.exec_driver_sql("ROLLBACK TO zrb_command")
+        conn.exec_driver_sql("RELEASE zrb_command")
+        raise
+    conn.exec_driver_sql("RELEASE zrb_command")
+
+
+class OrderRejected(Exception):
+    """
+    Order refused at submission. `reason` is "balance" or "holding" (with the
+    amount needed and available, in ledger units) or "user" if the user is unknown.
+    """
+
+    def __init__(self, reason, need=0, available=0):
+        super().__init__(reason)
+        self.reason = reason
+        self.need = need
+        self.available = available
+
+
+class MatchingEngine:
+    """
+    The single writer of orders, balances and holdings. One thread owns the order
+    book and runs commands (place / cancel / match / reset / user) from a queue in arrival
+    order; callers get a concurrent.futures.Future (asyncio.wrap_future() to await
+    it). Commands that queue up while a batch runs are executed together in one
+    transaction with one commit, followed by a single matching pass.
+    """
+
+    def __init__(self, market, max_batch=512):
+        self.market = market
+        self.db = market.db
+        self.max_batch = max(1, int(max_batch))
+        # Resting orders indexed by limit price, rebuilt from the orders table
+        self.order_book = OrderBook()
+        # Order ids are assigned here (the engine is the only writer) so a batch's new
+        # orders go in with one executemany
+        self._next_order_id = 1
+        self._new_orders = []
+        # Ledger deltas of the running batch, handed to market.positions after the commit
+        self._cash = {}       # user_id -> [balance, reserved_balance]
+        self._positions = {}  # (user_id, symbol) -> [amount, reserved_amount, cost_basis]
+        self._dropped = set() # users created or reset
+        self._load_order_book()
+        self._queue = queue.Queue()
+        self._stop = object()
+        self._stopped = False
+        self._submit_lock = threading.Lock()  # nothing is queued behind the stop marker
+        self.commands = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, name="zrb-matching", daemon=True)
+        self._thread.start()
+
+    # --- Commands (any thread) ---
+
+    def _submit(self, kind, *args):
+        future = Future()
+        with self._submit_lock:
+            if self._stopped:
+                future.set_exception(RuntimeError("Matching engine stopped"))
+            else:
+                self._queue.put((kind, args, future))
+        return future
+
+    def place(self, user_id, symbol, order_type, amount, price=None, create_user=False):
+        """
+        Submit an order (amount in lots, limit price in price units, None for market).
+        The cash (buy) or quantity (sell) it needs moves into the reserved bucket with
+        a conditional UPDATE, then the order is inserted as PENDING and matched right
+        away. Market buys reserve at the current price. Result: (order_id, OrderStatus,
+        execution price as in the fills feed, None unless filled); OrderRejected if
+        funds / holding are short.
+        """
+        return self._submit("place", user_id, symbol, order_type, amount, price, create_user)
+
+    def cancel(self, user_id, order_id):
+        """Cancel a user's PENDING order and release its reservation. Result: False if it isn't pending"""
+        return self._submit("cancel", user_id, order_id)
+
+    def match(self):
+        """Match the resting orders against the current prices (after a price tick)"""
+        return self._submit("match")
+
+    def reset(self, user_id):
+        """Delete a user's orders, fills and holdings and restore the initial balance"""
+        return self._submit("reset", user_id)
+
+    def ensure_user(self, user_id, password_hash=None):
+        """Create the user if missing and optionally set its web password hash. Result: True if created"""
+        return self._submit("user", user_id, password_hash)
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def stop(self):
+        """Run what is queued, then stop the thread; later commands fail right away"""
+        with self._submit_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._queue.put(self._stop)
+        self._thread.join()
+
+    # --- Engine thread ---
+
+    def _load_order_book(self):
+        try:
+            session = self.db.get_session()
+            self._next_order_id = (session.query(func.max(Order.id)).scalar() or 0) + 1
+            pending = session.query(*ORDER_COLUMNS).filter(Order.status == OrderStatus.PENDING).order_by(Order.id).all()
+            for order in pending:
+                self._book_add(order)
+            session.close()
+        except Exception as e:
+            print(f"Error loading order book: {e}")
+
+    def _book_add(self, order):
+        self.order_book.add(order.id, order.symbol, order.order_type == OrderType.BUY, order.price)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not self._stop and len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is self._stop
+            commands = batch[:-1] if stopping else batch
+            if commands:
+                self._process(commands)
+            if stopping:
+                return
+
+    def _process(self, commands):
+        replies = []   # (future, result) resolved after the commit
+        placed = []    # (future, order_id)
+        touched = set()
+        match = False
+        self._cash, self._positions, self._dropped = {}, {}, set()
+        positions = self.market.positions
+        session = self.db.get_session()
+        try:
+            # pysqlite only opens a transaction before DML, so a SAVEPOINT issued first
+            # would start (and its RELEASE commit) one of its own; open the batch's here
+            conn = session.connection()
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            for kind, args, future in commands:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if kind in ("cancel", "reset"):
+                    # Orders placed earlier in the batch go in first, outside the savepoint
+                    self._flush_orders(session)
+                try:
+                    # One SAVEPOINT per command: a failing command is rolled back alone and
+                    # only its caller gets the error. Commands update the book and the
+                    # ledger journal only after their SQL succeeded.
+                    with _savepoint(conn):
+                        if kind == "place":
+                            result = self._place(session, *args)
+                        elif kind == "cancel":
+                            result = self._cancel(session, *args)
+                        elif kind == "reset":
+                            result = self._reset(session, *args)
+                        elif kind == "user":
+                            result = self._ensure_user(session, *args)
+                        elif kind == "match":
+                            result = None
+                        else:
+                            raise ValueError(f"Unknown command '{kind}'")
+                except OrderRejected as e:
+                    future.set_exception(e)
+                    continue
+                except Exception as e:
+                    print(f"[Zirunbi] Matching command '{kind}' failed: {e}")
+                    future.set_exception(e)
+                    continue
+
+                if kind == "place":
+                    placed.append((future, result))
+                    touched.add(args[0])
+                    match = True
+                    continue
+                if kind == "match":
+                    match = True
+                elif kind != "cancel" or result:
+                    touched.add(args[0])
+                replies.append((future, result))
+
+            self._flush_orders(session)
+            filled, volumes = [], {}
+            if match:
+                filled, settled, volumes = self._match(session)
+                touched |= settled
+            positions.begin()
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            self._new_orders = []
+            positions.abort(touched | {u for u, _ in self._positions} | set(self._cash) | self._dropped)
+            print(f"[Zirunbi] Matching batch failed: {e}")
+            # The book may hold orders of the rolled back transaction
+            self.order_book.clear()
+            self._load_order_book()
+            for _, _, future in commands:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            session.close()
+
+        positions.apply(self._cash, self._positions, self._dropped)
+        self.commands += len(commands)
+        self.batches += 1
+        if volumes:
+            self.market.add_volume(volumes)
+        for user_id in touched:
+            self.market.bump_user(user_id)
+        if filled:
+            self.market._notify("fills", filled)
+
+        exec_prices = {f["order_id"]: f["price"] for f in filled}
+        for future, order_id in placed:
+            if order_id in exec_prices:
+                status = OrderStatus.FILLED
+            elif order_id in self.order_book:
+                status = OrderStatus.PENDING
+            else:
+                status = OrderStatus.CANCELLED  # short of funds at execution
+            future.set_result((order_id, status, exec_prices.get(order_id)))
+        for future, result in replies:
+            future.set_result(result)
+
+    def _flush_orders(self, session):
+        """Insert the orders placed so far in this batch"""
+        if self._new_orders:
+            session.execute(_orders.insert(), self._new_orders)
+            self._new_orders = []
+
+    def _place(self, session, user_id, symbol, order_type, amount, price, create_user):
+        if not 0 < amount <= MAX_UNITS or (price is not None and not 0 < price <= MAX_UNITS):
+            raise ValueError("Order amount and limit price must be positive 64-bit integers")
+        if order_type == OrderType.BUY:
+            value = buy_cost(price if price is not None else self.market.price_units[symbol], amount)
+            reserve = value + trade_fee(value)
+        else:
+            reserve = amount
+        # A non-positive reservation would credit the account instead
+        if reserve <= 0:
+            raise ValueError(f"Order reservation must be positive, got {reserve}")
+
+        if order_type == OrderType.BUY:
+            # A reservation past MAX_UNITS is more than any balance (and would overflow
+            # the INTEGER bind), so it is short of funds like any other
+            moved = reserve <= MAX_UNITS and session.connection().exec_driver_sql(
+                _RESERVE_CASH, (reserve, reserve, user_id, reserve)).rowcount
+            if not moved:
+                available = session.execute(_BALANCE, {"uid": user_id}).scalar()
+                if available is None:
+                    if not create_user:
+                        raise OrderRejected("user")
+                    self._ensure_user(session, user_id)
+                    return self._place(session, user_id, symbol, order_type, amount, price, False)
+                raise OrderRejected("balance", reserve, available)
+            self._cash_delta(user_id, -reserve, reserve)
+        else:
+            moved = session.connection().exec_driver_sql(
+                _RESERVE_QTY, (reserve, reserve, user_id, symbol, reserve)).rowcount
+            if not moved:
+                available = session.execute(_HOLDING, {"uid": user_id, "sym": symbol}).scalar()
+                raise OrderRejected("holding", reserve, available or 0)
+            self._position_delta(user_id, symbol, -reserve, reserve)
+
+        order_id = self._next_order_id
+        self._next_order_id += 1
+        self._new_orders.append({
+            "id": order_id, "user_id": user_id, "symbol": symbol, "order_type": order_type,
+            "price": price, "amount": amount, "reserved": reserve,
+        })
+        self.order_book.add(order_id, symbol, order_type == OrderType.BUY, price)
+        return order_id
+
+    def _ensure_user(self, session, user_id, password_hash=None):
+        created = session.execute(sqlite_insert(_users).values(
+            user_id=user_id, balance=INITIAL_BALANCE, reserved_balance=0
+        ).on_conflict_do_nothing(index_elements=["user_id"])).rowcount == 1
+        if password_hash is not None:
+            session.execute(_users.update().where(_users.c.user_id == user_id).values(password_hash=password_hash))
+        if created:
+            self._dropped.add(user_id)
+        return created
+
+    def _cancel(self, session, user_id, order_id):
+        row = session.execute(_orders.update().where(
+            _orders.c.id == order_id, _orders.c.user_id == user_id, _orders.c.status == OrderStatus.PENDING
+        ).values(status=OrderStatus.CANCELLED).returning(
+            _orders.c.symbol, _orders.c.order_type, _orders.c.reserved
+        )).first()
+        if row is None:
+            return False
+        self._release(session, user_id, row.symbol, row.order_type, row.reserved or 0)
+        self.order_book.remove(order_id)
+        return True
+
+    def _reset(self, session, user_id):
+        pending = session.execute(_orders.select().with_only_columns(_orders.c.id).where(
+            _orders.c.user_id == user_id, _orders.c.status == OrderStatus.PENDING)).scalars().all()
+        session.execute(_holdings.delete().where(_holdings.c.user_id == user_id))
+        session.execute(_orders.delete().where(_orders.c.user_id == user_id))
+        session.execute(_fills.delete().where(_fills.c.user_id == user_id))
+        session.execute(_users.update().where(_users.c.user_id == user_id).values(
+            balance=INITIAL_BALANCE, reserved_balance=0))
+        self._dropped.add(user_id)
+        for order_id in pending:
+            self.order_book.remove(order_id)
+
+    def _release(self, session, user_id, symbol, order_type, reserved):
+        """Move an order's reservation back to the free balance / holding"""
+        if not reserved:
+            return
+        if order_type == OrderType.BUY:
+            session.execute(_users.update().where(_users.c.user_id == user_id).values(
+                balance=_users.c.balance + reserved, reserved_balance=_users.c.reserved_balance - reserved))
+            self._cash_delta(user_id, reserved, -reserved)
+        else:
+            session.execute(_holdings.update().where(
+                _holdings.c.user_id == user_id, _holdings.c.symbol == symbol
+            ).values(amount=_holdings.c.amount + reserved, reserved_amount=_holdings.c.reserved_amount - reserved))
+            self._position_delta(user_id, symbol, reserved, -reserved)
+
+    def _cash_delta(self, user_id, balance, reserved):
+        delta = self._cash.setdefault(user_id, [0, 0])
+        delta[0] += balance
+        delta[1] += reserved
+
+    def _position_delta(self, user_id, symbol, amount, reserved, cost=0):
+        delta = self._positions.setdefault((user_id, symbol), [0, 0, 0])
+        delta[0] += amount
+        delta[1] += reserved
+        delta[2] += cost
+
+    def _crossing_price(self, order):
+        """Execution price (price units) if the order can fill right now, else None"""
+        if not self.market.is_open:
+            return None
+
+        current_price = self.market.price_units.get(order.symbol)
+        if not current_price:
+            return None
+
+        if order.price is None: # Market order
+            return current_price
+        if order.order_type == OrderType.BUY and current_price <= order.price:
+            return current_price
+        if order.order_type == OrderType.SELL and current_price >= order.price:
+            return current_price
+        return None
+
+    def _match(self, session):
+        """Fill the resting orders crossed by the current prices, see _execute_batch()"""
+        if not self.market.is_open:
+            return [], set(), {}
+
+        crossed = []
+        for sym in self.market.symbols:
+            price = self.market.price_units.get(sym)
+            if price:
+                crossed.extend(self.order_book.pop_crossing(sym, price))
+        if not crossed:
+            return [], set(), {}
+
+        rows = session.query(*ORDER_COLUMNS).filter(Order.id.in_(crossed), Order.status == OrderStatus.PENDING).all()
+        # Keep the book's priority (market FIFO, then best price)
+        rank = {oid: i for i, oid in enumerate(crossed)}
+        rows.sort(key=lambda o: rank[o.id])
+
+        fills = []
+        for order in rows:
+            exec_price = self._crossing_price(order)
+            if exec_price is None:
+                self._book_add(order)
+            else:
+                fills.append((order, exec_price))
+        return self._execute_batch(session, fills)
+
+    def _execute_batch(self, session, fills):
+        """
+        Settle a list of (order, exec_price) pairs against the reservations made at
+        submission, so balances are never read here. The orders are claimed with one
+        UPDATE ... WHERE status = PENDING, then balance / holding deltas are summed in
+        memory and applied as relative UPDATEs, one executemany per table. Fills, with
+        the realized P&L of sells against the holding's cost basis, are inserted in the
+        same transaction. All amounts are integer units (fixedpoint).
+        Returns (fill dicts, ids of the users whose ledger changed, {symbol: lots traded}).
+        """
+        if not fills:
+            return [], set(), {}
+
+        claimed = set(session.execute(_orders.update().where(
+            _orders.c.id.in_([order.id for order, _ in fills]), _orders.c.status == OrderStatus.PENDING
+        ).values(status=OrderStatus.FILLED).returning(_orders.c.id)).scalars())
+
+        # (user_id, symbol) -> [lots held, cost basis] of the positions sold from,
+        # kept current through the batch so a buy then a sell in one batch adds up
+        held = self._load_held(session, {
+            (order.user_id, order.symbol) for order, _ in fills
+            if order.id in claimed and order.order_type == OrderType.SELL
+        })
+
+        balances = {}   # user_id -> [balance delta, reserved_balance delta]
+        positions = {}  # (user_id, symbol) -> [amount delta, reserved_amount delta, cost_basis delta]
+        volumes = {}
+        filled = []
+        fill_rows = []
+        settled = set()
+        now = get_china_time()
+        for order, exec_price in fills:
+            if order.id not in claimed:
+                continue
+            settled.add(order.user_id)
+
+            if order.order_type == OrderType.BUY:
+                total_cost = buy_cost(exec_price, order.amount)
+            else:
+                total_cost = sell_proceeds(exec_price, order.amount)
+            fee = trade_fee(total_cost)
+            reserved = order.reserved or 0
+            # Normally <= 0. Positive for a market buy whose price rose since submission,
+            # or an order placed before reservations existed: take the rest from free funds
+            shortfall = (total_cost + fee if order.order_type == OrderType.BUY else order.amount) - reserved
+            if shortfall > 0 and not self._draw(session, order, shortfall):
+                session.execute(_orders.update().where(_orders.c.id == order.id).values(status=OrderStatus.CANCELLED))
+                self._release(session, order.user_id, order.symbol, order.order_type, reserved)
+                continue
+
+            key = (order.user_id, order.symbol)
+            bal = balances.setdefault(order.user_id, [0, 0])
+            pos = positions.setdefault(key, [0, 0, 0])
+            pnl = 0
+            if order.order_type == OrderType.BUY:
+                bal[0] += max(0, -shortfall)  # unused part of the reservation
+                bal[1] -= reserved
+                pos[0] += order.amount
+                pos[2] += total_cost + fee
+                if key in held:
+                    held[key][0] += order.amount
+                    held[key][1] += total_cost + fee
+            else:
+                pos[1] -= reserved
+                bal[0] += total_cost - fee
+                lots, cost = held.get(key, (0, 0))
+                sold_cost = prorate(cost, order.amount, lots) if lots > 0 else 0
+                pnl = total_cost - fee - sold_cost
+                pos[2] -= sold_cost
+                held[key] = [lots - order.amount, cost - sold_cost]
+
+            volumes[order.symbol] = volumes.get(order.symbol, 0) + order.amount
+            filled.append({
+                "order_id": order.id,
+                "user_id": order.user_id,
+                "symbol": order.symbol,
+                "side": order.order_type.value,
+                "price": from_price(exec_price),
+                "amount": from_qty(order.amount),
+                "fee": from_cash(fee),
+                "realized_pnl": from_cash(pnl),
+            })
+            fill_rows.append({
+                "order_id": order.id, "user_id": order.user_id, "symbol": order.symbol,
+                "side": order.order_type, "price": exec_price, "amount": order.amount,
+                "fee": fee, "realized_pnl": pnl, "timestamp": now,
+            })
+
+        if balances:
+            session.execute(_users.update().where(_users.c.user_id == bindparam("uid")).values(
+                balance=_users.c.balance + bindparam("d_balance"),
+                reserved_balance=_users.c.reserved_balance + bindparam("d_reserved")
+            ), [{"uid": u, "d_balance": b, "d_reserved": r} for u, (b, r) in balances.items()])
+        if positions:
+            upsert = sqlite_insert(_holdings)
+            upsert = upsert.on_conflict_do_update(index_elements=["user_id", "symbol"], set_={
+                "amount": _holdings.c.amount + upsert.excluded.amount,
+                "reserved_amount": _holdings.c.reserved_amount + upsert.excluded.reserved_amount,
+                "cost_basis": _holdings.c.cost_basis + upsert.excluded.cost_basis,
+            })
+            session.execute(upsert, [
+                {"user_id": u, "symbol": sym, "amount": a, "reserved_amount": r, "cost_basis": c}
+                for (u, sym), (a, r, c) in positions.items()
+            ])
+        if fill_rows:
+            session.execute(_fills.insert(), fill_rows)
+        for user_id, (b, r) in balances.items():
+            self._cash_delta(user_id, b, r)
+        for (user_id, sym), (a, r, c) in positions.items():
+            self._position_delta(user_id, sym, a, r, c)
+
+        return filled, settled, volumes
+
+    def _load_held(self, session, keys):
+        """{(user_id, symbol): [lots held incl. reserved, cost basis]} for `keys`"""
+        if not keys:
+            return {}
+        rows = session.execute(_holdings.select().with_only_columns(
+            _holdings.c.user_id, _holdings.c.symbol,
+            _holdings.c.amount + _holdings.c.reserved_amount, _holdings.c.cost_basis
+        ).where(_holdings.c.user_id.in_({user_id for user_id, _ in keys})))
+        return {(u, sym): [lots or 0, cost or 0] for u, sym, lots, cost in rows if (u, sym) in keys}
+
+    def _draw(self, session, order, extra):
+        """Take `extra` cash units (buy) or lots (sell) from the free balance / holding, if there is enough"""
+        if order.order_type == OrderType.BUY:
+            stmt = _users.update().where(_users.c.user_id == order.user_id, _users.c.balance >= extra).values(
+                balance=_users.c.balance - extra)
+        else:
+            stmt = _holdings.update().where(
+                _holdings.c.user_id == order.user_id, _holdings.c.symbol == order.symbol,
+                _holdings.c.amount >= extra
+            ).values(amount=_holdings.c.amount - extra)
+        if session.execute(stmt).rowcount != 1:
+            return False
+        if order.order_type == OrderType.BUY:
+            self._cash_delta(order.user_id, -extra, 0)
+        else:
+            self._position_delta(order.user_id, order.symbol, -extra, 0)
+        return True
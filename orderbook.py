@@ -0,0 +1,120 @@
+import heapq
+import itertools
+import threading
+from collections import deque
+
+
+class _SymbolBook:
+    def __init__(self):
+        # Buy heap is keyed by negated limit price (highest bid on top),
+        # sell heap by limit price (lowest ask on top). Entries: (key, seq, order_id)
+        self.buys = []
+        self.sells = []
+        # Market orders have no limit price, they cross on any tick (FIFO)
+        self.market = deque()
+        # Entries removed by cancel but still sitting in a heap
+        self.stale = 0
+
+    def size(self):
+        return len(self.buys) + len(self.sells) + len(self.market)
+
+
+class OrderBook:
+    """
+    In-memory index of PENDING orders per symbol.
+    The `orders` table stays the source of truth, the book only tells the
+    matcher which order ids a given price crosses.
+    """
+
+    def __init__(self):
+        self._books = {}
+        self._live = {}  # order_id -> symbol
+        self._seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def _book(self, symbol):
+        book = self._books.get(symbol)
+        if book is None:
+            book = self._books[symbol] = _SymbolBook()
+        return book
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, order_id):
+        return order_id in self._live
+
+    def clear(self):
+        with self.lock:
+            self._books.clear()
+            self._live.clear()
+
+    def add(self, order_id, symbol, is_buy, price=None):
+        with self.lock:
+            if order_id in self._live:
+                return
+            book = self._book(symbol)
+            seq = next(self._seq)
+            if price is None:
+                book.market.append(order_id)
+            elif is_buy:
+                heapq.heappush(book.buys, (-price, seq, order_id))
+            else:
+                heapq.heappush(book.sells, (price, seq, order_id))
+            self._live[order_id] = symbol
+
+    def remove(self, order_id):
+        """Lazy removal: the heap entry is skipped when it surfaces"""
+        with self.lock:
+            symbol = self._live.pop(order_id, None)
+            if symbol is None:
+                return False
+            book = self._books[symbol]
+            book.stale += 1
+            # Compact once dead entries outnumber live ones
+            if book.stale > 64 and book.stale * 2 > book.size():
+                self._compact(book)
+            return True
+
+    def _compact(self, book):
+        book.buys = [e for e in book.buys if e[2] in self._live]
+        book.sells = [e for e in book.sells if e[2] in self._live]
+        heapq.heapify(book.buys)
+        heapq.heapify(book.sells)
+        book.market = deque(oid for oid in book.market if oid in self._live)
+        book.stale = 0
+
+    def pop_crossing(self, symbol, price):
+        """
+        Remove and return the ids of every order crossed by `price`:
+        market orders first (FIFO), then buys with limit >= price (best bid first),
+        then sells with limit <= price (best ask first).
+        """
+        with self.lock:
+            book = self._books.get(symbol)
+            if book is None:
+                return []
+
+            crossed = []
+            while book.market:
+                oid = book.market.popleft()
+                if self._live.pop(oid, None) is not None:
+                    crossed.append(oid)
+                else:
+                    book.stale -= 1
+
+            while book.buys and -book.buys[0][0] >= price:
+                _, _, oid = heapq.heappop(book.buys)
+                if self._live.pop(oid, None) is not None:
+                    crossed.append(oid)
+                else:
+                    book.stale -= 1
+
+            while book.sells and book.sells[0][0] <= price:
+                _, _, oid = heapq.heappop(book.sells)
+                if self._live.pop(oid, None) is not None:
+                    crossed.append(oid)
+                else:
+                    book.stale -= 1
+
+            return crossed
@@ -0,0 +1,100 @@
+import queue
+import threading
+import time
+
+
+class PersistenceWriter:
+    """
+    Write-behind queue for append-only rows (candles, news). Producers hand over
+    plain dicts and return immediately; a background thread drains the queue and
+    inserts each batch with one executemany per table and a single commit.
+    """
+
+    def __init__(self, db, batch_size=500, flush_interval=0.5, retries=3):
+        self.db = db
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self._queue = queue.Queue()
+        self._stop = object()
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="zrb-persist", daemon=True)
+        self._thread.start()
+
+    def submit(self, model, rows, on_commit=None):
+        """
+        Queue rows (list of column dicts) for insertion into `model`'s table.
+        on_commit() is called from the writer thread once they are committed.
+        """
+        if rows:
+            self._queue.put((model.__table__, rows, on_commit))
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """Block until everything submitted so far is written"""
+        self._queue.join()
+
+    def stop(self):
+        """Write what is queued, then stop the thread"""
+        self._queue.put(self._stop)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            # Group whatever else arrived meanwhile (or shortly after) into the same commit
+            deadline = time.monotonic() + self.flush_interval
+            while item is not self._stop and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                batch.append(item)
+
+            stopping = batch[-1] is self._stop
+            records = batch[:-1] if stopping else batch
+            if records:
+                self._write(records)
+            for _ in batch:
+                self._queue.task_done()
+            if stopping:
+                return
+
+    def _write(self, records):
+        by_table = {}
+        for table, rows, _ in records:
+            by_table.setdefault(table, []).extend(rows)
+
+        for attempt in range(1, self.retries + 1):
+            session = self.db.get_session()
+            try:
+                for table, rows in by_table.items():
+                    session.execute(table.insert(), rows)
+                session.commit()
+                self.written += sum(len(rows) for rows in by_table.values())
+                self.batches += 1
+                break
+            except Exception as e:
+                session.rollback()
+                print(f"[Zirunbi] Persistence write failed (attempt {attempt}): {e}")
+                time.sleep(0.5 * attempt)
+            finally:
+                session.close()
+        else:
+            lost = sum(len(rows) for rows in by_table.values())
+            self.dropped += lost
+            print(f"[Zirunbi] Giving up, dropped {lost} rows")
+            return
+
+        for _, _, on_commit in records:
+            if on_commit is not None:
+                try:
+                    on_commit()
+                except Exception as e:
+                    print(f"[Zirunbi] Persistence callback error: {e}")
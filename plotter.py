@@ -1,8 +1,15 @@
+import matplotlib
+# Non-interactive backend, selected once at import
+matplotlib.use('Agg')
 import mplfinance as mpf
 import pandas as pd
 import io
 import matplotlib.pyplot as plt
 import os
+try:
+    from .fixedpoint import PRICE_SCALE, QTY_SCALE
+except ImportError:
+    from fixedpoint import PRICE_SCALE, QTY_SCALE
 try:
     from mplfonts.bin.cli import init
     init()
@@ -19,39 +26,50 @@ def init_font(font_path=None):
     # But mplfonts should handle most cases automatically
     pass
 
-def plot_kline(history_data, title="K-Line"):
-    if not history_data:
+# Built once per process, see _get_style()
+_kline_style = None
+
+def _get_style():
+    global _kline_style
+    if _kline_style is None:
+        # Custom Style: Red for Up, Green for Down (China Standard)
+        mc = mpf.make_marketcolors(up='r', down='g', edge='i', wick='i', volume='in', inherit=True)
+        _kline_style = mpf.make_mpf_style(marketcolors=mc, gridstyle='--', y_on_right=True)
+    return _kline_style
+
+def warm_up():
+    """Pay the backend / style setup once (used by renderer worker processes)"""
+    _get_style()
+
+def kline_payload(history_data):
+    """Convert MarketHistory rows (integer units) to plain OHLCV arrays (picklable, no ORM objects)"""
+    return {
+        'dates': [h.timestamp.strftime('%Y-%m-%d %H:%M') for h in history_data],
+        'open': [h.open / PRICE_SCALE for h in history_data],
+        'high': [h.high / PRICE_SCALE for h in history_data],
+        'low': [h.low / PRICE_SCALE for h in history_data],
+        'close': [h.close / PRICE_SCALE for h in history_data],
+        'volume': [h.volume / QTY_SCALE for h in history_data],
+    }
+
+def render_kline(payload, title="K-Line"):
+    """Render OHLCV arrays to PNG bytes"""
+    if not payload or not payload['dates']:
         return None
-        
-    data = []
-    for h in history_data:
-        # Ensure timestamp is formatted correctly
-        ts = h.timestamp.strftime('%Y-%m-%d %H:%M')
-        data.append({
-            'Date': ts,
-            'Open': h.open,
-            'High': h.high,
-            'Low': h.low,
-            'Close': h.close,
-            'Volume': h.volume
-        })
-    
-    df = pd.DataFrame(data)
-    # Convert 'Date' to datetime index
-    df.index = pd.DatetimeIndex(df['Date'])
-    
+
+    df = pd.DataFrame({
+        'Open': payload['open'],
+        'High': payload['high'],
+        'Low': payload['low'],
+        'Close': payload['close'],
+        'Volume': payload['volume'],
+    }, index=pd.DatetimeIndex(payload['dates']))
+
     buf = io.BytesIO()
-    # Use non-interactive backend
-    plt.switch_backend('Agg')
-    
-    # Custom Style: Red for Up, Green for Down (China Standard)
-    mc = mpf.make_marketcolors(up='r', down='g', edge='i', wick='i', volume='in', inherit=True)
-    s = mpf.make_mpf_style(marketcolors=mc, gridstyle='--', y_on_right=True)
-    
     try:
         # Use returnfig=True to allow adding text
         # datetime_format ensures X-axis is readable
-        fig, axlist = mpf.plot(df, type='candle', style=s, title=title, volume=True, 
+        fig, axlist = mpf.plot(df, type='candle', style=_get_style(), title=title, volume=True, 
                                datetime_format='%m-%d %H:%M', returnfig=True)
         
         # Add Legend/Explanation in Chinese
@@ -63,16 +81,16 @@ def plot_kline(history_data, title="K-Line"):
                 verticalalignment='top', bbox=dict(boxstyle='round', facecolor='white', alpha=0.9))
         
         fig.savefig(buf, format='png', bbox_inches='tight')
-        buf.seek(0)
         plt.close(fig)
-        return buf
+        return buf.getvalue()
     except Exception as e:
         print(f"Plot error: {e}")
         return None
 
-def plot_holdings_multi(balance, holdings_data, title="User Holdings"):
+def render_holdings(balance, holdings_data, title="User Holdings"):
     """
     holdings_data: dict {symbol: value}
+    Returns PNG bytes
     """
     labels = ['Cash']
     sizes = [balance]
@@ -86,15 +104,20 @@ def plot_holdings_multi(balance, holdings_data, title="User Holdings"):
         sizes = [1]
         labels = ['Empty']
 
-    plt.switch_backend('Agg')
     fig, ax = plt.subplots()
     ax.pie(sizes, labels=labels, autopct='%1.1f%%', shadow=True, startangle=90)
     ax.axis('equal')
     
-    plt.title(title)
+    ax.set_title(title)
     
     buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
+    fig.savefig(buf, format='png')
     plt.close(fig)
-    return buf
+    return buf.getvalue()
+
+def plot_kline(history_data, title="K-Line"):
+    png = render_kline(kline_payload(history_data), title=title)
+    return io.BytesIO(png) if png else None
+
+def plot_holdings_multi(balance, holdings_data, title="User Holdings"):
+    return io.BytesIO(render_holdings(balance, holdings_data, title=title))
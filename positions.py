@@ -0,0 +1,225 @@
+import heapq
+import threading
+from collections import OrderedDict
+try:
+    from .database import User, UserHolding
+    from .fixedpoint import trade_value
+except ImportError:
+    from database import User, UserHolding
+    from fixedpoint import trade_value
+
+_users = User.__table__
+_holdings = UserHolding.__table__
+
+
+def mask_user_id(user_id):
+    """Public form of a user id for rankings, e.g. 12345678 -> 123***78"""
+    user_id = str(user_id)
+    if len(user_id) <= 4:
+        return user_id[:1] + "***"
+    return f"{user_id[:3]}***{user_id[-2:]}"
+
+
+class Account:
+    """Ledger of one user in integer units (fixedpoint), plus its value at the last tick"""
+    __slots__ = ("balance", "reserved_balance", "positions", "value")
+
+    def __init__(self, balance, reserved_balance, positions):
+        self.balance = balance
+        self.reserved_balance = reserved_balance
+        # symbol -> [amount, reserved_amount, cost_basis]
+        self.positions = positions
+        self.value = 0
+
+    @property
+    def equity(self):
+        return self.balance + self.reserved_balance + self.value
+
+    def revalue(self, prices):
+        # Price units x lots summed first, rounded to cash units once
+        notional = 0
+        for sym, pos in self.positions.items():
+            notional += prices.get(sym, 0) * (pos[0] + pos[1])
+        self.value = trade_value(notional, 1)
+
+    def snapshot(self):
+        return {
+            "balance": self.balance,
+            "reserved_balance": self.reserved_balance,
+            "positions": {sym: tuple(pos) for sym, pos in self.positions.items()},
+            "value": self.value,
+            "equity": self.equity,
+        }
+
+
+class PositionCache:
+    """
+    Cash, positions and cost basis of recently active users, so asset views and the
+    leaderboard never touch the database. Accounts are loaded on first use and evicted
+    LRU beyond `max_users`. The matching engine (the only ledger writer) hands over each
+    batch's deltas after its commit; mark() revalues the cached accounts once per tick.
+
+    A load racing a commit could see the ledger either before or after it, so loaded
+    rows are only kept when no batch was in flight for the whole load.
+    """
+
+    def __init__(self, db, prices, max_users=1024):
+        self.db = db
+        self.max_users = max(1, int(max_users))
+        self._prices = dict(prices)
+        self._accounts = OrderedDict()  # user_id -> Account, least recently used first
+        self._lock = threading.Lock()
+        self._seq = 0           # moves when a batch starts committing
+        self._in_flight = False
+        # Moves whenever a cached account changes, for conditional GETs of the leaderboard
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    # --- Reads (any thread) ---
+
+    def peek(self, user_id):
+        """Snapshot dict of a cached account, None if it isn't cached (never blocks on I/O)"""
+        with self._lock:
+            account = self._accounts.get(user_id)
+            if account is None:
+                return None
+            self._accounts.move_to_end(user_id)
+            self.hits += 1
+            return account.snapshot()
+
+    def get(self, user_id):
+        """Snapshot dict of a user's account, loaded from the database on a miss; None for unknown users"""
+        snapshot = self.peek(user_id)
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            self.misses += 1
+        accounts = self._load([user_id])
+        account = accounts.get(user_id)
+        return account.snapshot() if account is not None else None
+
+    def top(self, n=10):
+        """[(user_id, snapshot), ...] of the cached accounts with the highest equity"""
+        with self._lock:
+            best = heapq.nlargest(n, self._accounts.items(), key=lambda item: item[1].equity)
+            return [(user_id, account.snapshot()) for user_id, account in best]
+
+    def rank(self, user_id):
+        """1-based position of a cached user by equity, None if not cached"""
+        with self._lock:
+            account = self._accounts.get(user_id)
+            if account is None:
+                return None
+            equity = account.equity
+            return 1 + sum(1 for other in self._accounts.values() if other.equity > equity)
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"users": len(self._accounts), "max_users": self.max_users, "hits": self.hits,
+                    "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    # --- Loading ---
+
+    def warm(self):
+        """Load up to max_users accounts, so the leaderboard covers them from the start"""
+        session = self.db.get_read_session()
+        try:
+            user_ids = session.execute(_users.select().with_only_columns(_users.c.user_id)
+                                       .limit(self.max_users)).scalars().all()
+        finally:
+            session.close()
+        self._load(user_ids)
+
+    def _load(self, user_ids):
+        with self._lock:
+            seq = self._seq
+            cacheable = not self._in_flight
+        session = self.db.get_read_session()
+        try:
+            accounts = {}
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                for user_id, balance, reserved in session.execute(_users.select().with_only_columns(
+                        _users.c.user_id, _users.c.balance, _users.c.reserved_balance
+                ).where(_users.c.user_id.in_(chunk))):
+                    accounts[user_id] = Account(balance or 0, reserved or 0, {})
+                for user_id, symbol, amount, reserved, cost in session.execute(_holdings.select().with_only_columns(
+                        _holdings.c.user_id, _holdings.c.symbol, _holdings.c.amount,
+                        _holdings.c.reserved_amount, _holdings.c.cost_basis
+                ).where(_holdings.c.user_id.in_(chunk))):
+                    if user_id in accounts:
+                        accounts[user_id].positions[symbol] = [amount or 0, reserved or 0, cost or 0]
+        finally:
+            session.close()
+
+        with self._lock:
+            for account in accounts.values():
+                account.revalue(self._prices)
+            if cacheable and seq == self._seq:
+                for user_id, account in accounts.items():
+                    # Accounts cached meanwhile already carry later deltas
+                    self._accounts.setdefault(user_id, account)
+                    self._accounts.move_to_end(user_id)
+                self._evict()
+        return accounts
+
+    def _evict(self):
+        while len(self._accounts) > self.max_users:
+            self._accounts.popitem(last=False)
+
+    # --- Updates (matching engine / market thread) ---
+
+    def begin(self):
+        """A ledger batch is about to commit"""
+        with self._lock:
+            self._seq += 1
+            self._in_flight = True
+
+    def apply(self, cash, positions, dropped):
+        """
+        Deltas of a committed batch: cash {user_id: [balance, reserved_balance]},
+        positions {(user_id, symbol): [amount, reserved_amount, cost_basis]}, and
+        users whose accounts were recreated (reset / new) and must be reloaded.
+        """
+        with self._lock:
+            for user_id in dropped:
+                self._accounts.pop(user_id, None)
+            changed = set()
+            for user_id, (d_balance, d_reserved) in cash.items():
+                account = self._accounts.get(user_id)
+                if account is not None:
+                    account.balance += d_balance
+                    account.reserved_balance += d_reserved
+                    changed.add(user_id)
+            for (user_id, symbol), deltas in positions.items():
+                account = self._accounts.get(user_id)
+                if account is not None:
+                    pos = account.positions.setdefault(symbol, [0, 0, 0])
+                    for i, delta in enumerate(deltas):
+                        pos[i] += delta
+                    changed.add(user_id)
+            for user_id in changed:
+                self._accounts[user_id].revalue(self._prices)
+            self._in_flight = False
+            if changed or dropped:
+                self.version += 1
+
+    def abort(self, user_ids=()):
+        """The batch rolled back; drop the accounts it touched in case the cache drifted"""
+        with self._lock:
+            for user_id in user_ids:
+                self._accounts.pop(user_id, None)
+            self._in_flight = False
+
+    def mark(self, prices):
+        """Revalue the cached accounts at new prices ({symbol: price units})"""
+        with self._lock:
+            self._prices = dict(prices)
+            for account in self._accounts.values():
+                account.revalue(self._prices)
+            self.version += 1
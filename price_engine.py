@@ -0,0 +1,82 @@
+import numpy as np
+
+# Stochastic models PriceEngine.step() can run
+MODELS = ("gbm", "jump", "mean_revert")
+
+
+class PriceEngine:
+    """
+    Advances the prices of all symbols at once with NumPy. Time is measured in
+    ticks: with dt=1 a symbol moves by about `volatility` per step.
+
+      gbm:         geometric Brownian motion, log-return (mu - sigma^2/2)dt + sigma*sqrt(dt)*Z
+      jump:        gbm plus Poisson jumps (Merton), log jump size ~ N(jump_mean, jump_std)
+      mean_revert: Ornstein-Uhlenbeck on log price, pulled towards the starting price
+
+    drift / volatility are scalars or one value per symbol. Shocks are correlated
+    either with a full correlation matrix (Cholesky factor, fine up to a few
+    thousand symbols) or a scalar: a one-factor model where every pair has that
+    correlation, which stays O(n) for any number of symbols.
+    """
+
+    def __init__(self, prices, volatility=0.02, drift=0.0, model="gbm", correlation=None, seed=None,
+                 jump_intensity=0.01, jump_mean=0.0, jump_std=0.05, reversion=0.05, floor=0.01):
+        if model not in MODELS:
+            raise ValueError(f"Unknown price model '{model}', use one of {MODELS}")
+        self.model = model
+        self.prices = np.maximum(np.asarray(prices, dtype=np.float64), floor)
+        n = len(self.prices)
+        self.volatility = np.broadcast_to(np.asarray(volatility, dtype=np.float64), (n,)).copy()
+        self.drift = np.broadcast_to(np.asarray(drift, dtype=np.float64), (n,)).copy()
+        self.jump_intensity = jump_intensity
+        self.jump_mean = jump_mean
+        self.jump_std = jump_std
+        self.reversion = reversion
+        self.floor = floor
+        self.rng = np.random.default_rng(seed)
+        # Mean-reversion target (log price)
+        self.anchor = np.log(self.prices)
+
+        self._chol = None
+        self._rho = 0.0
+        if correlation is not None and np.ndim(correlation) == 2:
+            self._chol = np.linalg.cholesky(np.asarray(correlation, dtype=np.float64))
+        elif correlation:
+            self._rho = float(correlation)
+            if not 0.0 <= self._rho < 1.0:
+                raise ValueError("Scalar correlation must be in [0, 1)")
+
+    def __len__(self):
+        return len(self.prices)
+
+    def _shocks(self):
+        n = len(self.prices)
+        z = self.rng.standard_normal(n)
+        if self._chol is not None:
+            return self._chol @ z
+        if self._rho:
+            common = self.rng.standard_normal()
+            return np.sqrt(self._rho) * common + np.sqrt(1.0 - self._rho) * z
+        return z
+
+    def step(self, dt=1.0):
+        """Advance every symbol by `dt` ticks, returns the new price array"""
+        sigma = self.volatility
+        diffusion = sigma * np.sqrt(dt) * self._shocks()
+
+        if self.model == "mean_revert":
+            log_p = np.log(self.prices)
+            log_p += self.reversion * dt * (self.anchor - log_p) + diffusion
+            self.prices = np.exp(log_p)
+        else:
+            log_ret = (self.drift - 0.5 * sigma * sigma) * dt + diffusion
+            if self.model == "jump":
+                jumps = self.rng.poisson(self.jump_intensity * dt, len(self.prices))
+                hit = jumps > 0
+                if hit.any():
+                    k = jumps[hit]
+                    log_ret[hit] += k * self.jump_mean + np.sqrt(k) * self.jump_std * self.rng.standard_normal(k.size)
+            self.prices = self.prices * np.exp(log_ret)
+
+        np.maximum(self.prices, self.floor, out=self.prices)
+        return self.prices
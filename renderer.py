@@ -0,0 +1,186 @@
+import multiprocessing
+import queue
+import threading
+
+try:
+    from . import plotter
+except ImportError:
+    import plotter
+
+
+class RenderTimeout(Exception):
+    """A render job (or the wait for a free worker) exceeded its timeout"""
+    pass
+
+
+# Job kinds a worker accepts. Arguments must be plain data (lists, dicts, numbers)
+RENDERERS = {
+    "kline": plotter.render_kline,
+    "holdings": plotter.render_holdings,
+}
+
+
+def _worker_main(conn):
+    # matplotlib / mplfinance / mplfonts were imported with this module,
+    # build the chart style once, tell the pool, then serve jobs until told to stop
+    plotter.warm_up()
+    conn.send("ready")
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        kind, args, kwargs = job
+        try:
+            conn.send(("ok", RENDERERS[kind](*args, **kwargs)))
+        except Exception as e:
+            conn.send(("err", f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.renders = 0
+        self.ready = False  # set by the handshake sent after warm_up()
+
+    def stop(self, timeout=2):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class RenderPool:
+    """
+    Long-lived chart rendering processes. Workers import matplotlib once, keep the
+    mplfinance style and are recycled after `max_renders` jobs to cap memory growth.
+    A job that runs past `timeout` seconds gets its worker killed and replaced.
+    With processes=0 jobs are rendered in the calling thread.
+    """
+
+    def __init__(self, processes=2, max_renders=100, timeout=30.0):
+        self.processes = max(0, int(processes))
+        self.max_renders = max(1, int(max_renders))
+        self.timeout = float(timeout)
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        for _ in range(self.processes):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        try:
+            return _Worker(self._ctx)
+        except Exception as e:
+            print(f"[Zirunbi] Failed to start render worker: {e}")
+            return None
+
+    def _handshake(self, worker):
+        """"ready", "dead" (exited before warming up) or "slow" (silent past the timeout)"""
+        if worker.ready:
+            return "ready"
+        try:
+            if not worker.conn.poll(self.timeout):
+                return "slow"
+            worker.ready = worker.conn.recv() == "ready"
+        except (EOFError, OSError):
+            return "dead"
+        return "ready" if worker.ready else "dead"
+
+    def _fall_back(self):
+        """Render in threads from now on and stop the idle workers"""
+        print("[Zirunbi] Render processes unavailable, rendering in threads")
+        self.processes = 0
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.stop()
+
+    def render(self, kind, *args, **kwargs):
+        """Blocking: render a chart and return PNG bytes (or None if the plot failed)"""
+        if self.processes == 0:
+            return RENDERERS[kind](*args, **kwargs)
+
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RenderTimeout(f"no render worker free within {self.timeout}s")
+
+        try:
+            if worker is None or not worker.process.is_alive() or worker.renders >= self.max_renders:
+                if worker is not None:
+                    worker.stop()
+                worker = self._spawn()
+                if worker is None:
+                    # Could not start a process, degrade to rendering in this thread
+                    return RENDERERS[kind](*args, **kwargs)
+
+            state = self._handshake(worker)
+            if state != "ready":
+                worker.kill()
+                worker = None
+                if state == "slow":
+                    raise RenderTimeout(f"render worker not ready within {self.timeout}s")
+                # A worker that dies before its first job will never work here (e.g. the
+                # host's __main__ can't be re-imported by spawn)
+                self._fall_back()
+                return RENDERERS[kind](*args, **kwargs)
+
+            worker.conn.send((kind, args, kwargs))
+            if not worker.conn.poll(self.timeout):
+                worker.kill()
+                worker = None
+                raise RenderTimeout(f"{kind} render exceeded {self.timeout}s")
+
+            worker.renders += 1
+            status, result = worker.conn.recv()
+            if status != "ok":
+                print(f"[Zirunbi] Render error ({kind}): {result}")
+                return None
+            return result
+        except (EOFError, OSError) as e:
+            # Worker died mid-job (OOM kill, crash in the plot); the slot is respawned
+            print(f"[Zirunbi] Render worker crashed: {e}")
+            if worker is not None:
+                worker.kill()
+            worker = None
+            return None
+        finally:
+            with self._lock:
+                if self._closed or self.processes == 0:
+                    if worker is not None:
+                        worker.stop()
+                else:
+                    # Dead slots are respawned lazily by the next job
+                    self._idle.put(worker)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.stop()
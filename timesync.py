@@ -0,0 +1,138 @@
+import socket
+import struct
+import threading
+import time
+import urllib.request
+from email.utils import parsedate_to_datetime
+
+# Seconds to add to the local clock to get network time. Written by TimeSync,
+# read by database.get_china_time() without any I/O
+_offset = 0.0
+
+
+def current_offset():
+    return _offset
+
+
+def set_offset(offset):
+    global _offset
+    _offset = float(offset)
+
+
+class HttpDateSource:
+    """Offset from the Date header of an HTTP HEAD response (1s resolution)"""
+    name = "http"
+
+    def __init__(self, url="http://www.baidu.com", timeout=3):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch_offset(self):
+        request = urllib.request.Request(self.url, method="HEAD")
+        sent = time.time()
+        with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+            date_str = resp.headers.get("Date")
+        received = time.time()
+        if not date_str:
+            raise ValueError("no Date header")
+        # The header is truncated to whole seconds, +0.5s centres the estimate
+        server = parsedate_to_datetime(date_str).timestamp() + 0.5
+        return server - (sent + received) / 2
+
+
+class NtpSource:
+    """Offset from an SNTP (RFC 4330) query"""
+    name = "ntp"
+    NTP_EPOCH_DELTA = 2208988800  # 1900-01-01 -> 1970-01-01
+
+    def __init__(self, host="ntp.aliyun.com", port=123, timeout=3):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def _to_unix(self, seconds, fraction):
+        return seconds - self.NTP_EPOCH_DELTA + fraction / 2 ** 32
+
+    def fetch_offset(self):
+        # LI=0, VN=4, Mode=3 (client)
+        packet = b"\x23" + b"\0" * 47
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            t1 = time.time()
+            sock.sendto(packet, (self.host, self.port))
+            data, _ = sock.recvfrom(512)
+            t4 = time.time()
+        if len(data) < 48:
+            raise ValueError("short NTP reply")
+        fields = struct.unpack("!12I", data[:48])
+        t2 = self._to_unix(fields[8], fields[9])    # receive timestamp
+        t3 = self._to_unix(fields[10], fields[11])  # transmit timestamp
+        return ((t2 - t1) + (t3 - t4)) / 2
+
+
+class StaticSource:
+    """Fixed offset, for offline machines and tests"""
+    name = "static"
+
+    def __init__(self, offset=0.0):
+        self.offset = offset
+
+    def fetch_offset(self):
+        return self.offset
+
+
+def make_source(kind, server=""):
+    """Time source for the `time_source` option, None when sync is disabled"""
+    kind = (kind or "http").lower()
+    if kind == "http":
+        return HttpDateSource(server) if server else HttpDateSource()
+    if kind == "ntp":
+        return NtpSource(server) if server else NtpSource()
+    if kind in ("disabled", "none", "off"):
+        return None
+    raise ValueError(f"Unknown time source '{kind}', use http, ntp or disabled")
+
+
+class TimeSync:
+    """
+    Refreshes the global clock offset from `source` in a background thread: first
+    right after start(), then every `interval` seconds. Failures keep the last
+    known offset and retry sooner (after `retry` seconds).
+    """
+
+    def __init__(self, source, interval=3600, retry=60):
+        self.source = source
+        self.interval = max(1.0, float(interval))
+        self.retry = min(self.interval, max(1.0, float(retry)))
+        self.last_sync = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sync_once(self):
+        """Query the source and update the offset; returns True on success"""
+        try:
+            offset = self.source.fetch_offset()
+        except Exception as e:
+            print(f"[Zirunbi] Time sync ({self.source.name}) failed: {e}")
+            return False
+        set_offset(offset)
+        self.last_sync = time.time()
+        print(f"[Zirunbi] Time synced ({self.source.name}). Offset: {offset:.2f}s")
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            ok = self.sync_once()
+            self._stop.wait(self.interval if ok else self.retry)
+
+    def start(self):
+        if self.source is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="zrb-timesync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            # A query in flight is bounded by the source timeout; don't wait for it
+            self._thread.join(0.5)
@@ -0,0 +1,100 @@
+import bisect
+import threading
+from datetime import datetime, date, time as dtime, timedelta, timezone
+
+CHINA_TZ = timezone(timedelta(hours=8))
+
+DEFAULT_SESSIONS = ("09:30-11:30", "13:00-15:00")
+DEFAULT_WEEKDAYS = (1, 2, 3, 4, 5)  # ISO weekdays, Monday = 1
+
+WEEKDAY_NAMES = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"]
+
+
+def parse_sessions(sessions):
+    """["09:30-11:30", ...] -> sorted [(time, time), ...]"""
+    parsed = []
+    for item in sessions:
+        start, end = (datetime.strptime(part.strip(), "%H:%M").time() for part in str(item).split("-"))
+        if end <= start:
+            raise ValueError(f"Session '{item}' ends before it starts")
+        parsed.append((start, end))
+    parsed.sort()
+    for (_, prev_end), (start, _) in zip(parsed, parsed[1:]):
+        if start <= prev_end:
+            raise ValueError("Trading sessions overlap")
+    return parsed
+
+
+class TradingCalendar:
+    """
+    Session open/close instants precomputed for the next `horizon_days` days into
+    one sorted list (open, close, open, close, ...). "Is open" and "next transition"
+    are a bisect on that list, which is rebuilt once time moves past half the horizon.
+    """
+
+    def __init__(self, sessions=DEFAULT_SESSIONS, weekdays=DEFAULT_WEEKDAYS, holidays=(), tz=CHINA_TZ,
+                 horizon_days=60):
+        self.sessions = parse_sessions(sessions)
+        if not self.sessions:
+            raise ValueError("At least one trading session is required")
+        self.weekdays = frozenset(int(d) for d in weekdays)
+        self.holidays = frozenset(
+            d if isinstance(d, date) else date.fromisoformat(str(d).strip()) for d in holidays
+        )
+        self.tz = tz
+        self.horizon_days = max(2, int(horizon_days))
+        self._edges = []
+        self._built_from = None
+        self._valid_until = None
+        self._lock = threading.Lock()
+
+    def is_trading_day(self, day):
+        return day.isoweekday() in self.weekdays and day not in self.holidays
+
+    def day_sessions(self, day):
+        """[(open, close), ...] instants of `day`, empty on weekends and holidays"""
+        if not self.is_trading_day(day):
+            return []
+        return [(datetime.combine(day, start, self.tz), datetime.combine(day, end, self.tz))
+                for start, end in self.sessions]
+
+    def _edges_at(self, now):
+        with self._lock:
+            if self._built_from is None or not (self._built_from <= now < self._valid_until):
+                # Start at yesterday's midnight so the session in progress is covered
+                first = now.date() - timedelta(days=1)
+                edges = []
+                for offset in range(self.horizon_days + 1):
+                    for session in self.day_sessions(first + timedelta(days=offset)):
+                        edges.extend(session)
+                self._edges = edges
+                self._built_from = datetime.combine(first, dtime(), self.tz)
+                self._valid_until = self._built_from + timedelta(days=self.horizon_days // 2 + 1)
+            return self._edges
+
+    def _now(self, now):
+        return now.astimezone(self.tz) if now is not None else datetime.now(self.tz)
+
+    def is_open(self, now=None):
+        now = self._now(now)
+        # An odd number of edges at or before now means we are inside a session
+        return bisect.bisect_right(self._edges_at(now), now) % 2 == 1
+
+    def next_transition(self, now=None):
+        """(instant, opens) of the next open/close after `now`, or (None, False) if none is scheduled"""
+        now = self._now(now)
+        edges = self._edges_at(now)
+        i = bisect.bisect_right(edges, now)
+        if i >= len(edges):
+            return None, False
+        return edges[i], i % 2 == 0
+
+    def describe(self):
+        """Human readable schedule, e.g. "周一至周五 09:30-11:30, 13:00-15:00" """
+        days = sorted(self.weekdays)
+        if len(days) > 2 and days == list(range(days[0], days[-1] + 1)):
+            day_text = f"{WEEKDAY_NAMES[days[0] - 1]}至{WEEKDAY_NAMES[days[-1] - 1]}"
+        else:
+            day_text = "、".join(WEEKDAY_NAMES[d - 1] for d in days)
+        sessions = ", ".join(f"{s:%H:%M}-{e:%H:%M}" for s, e in self.sessions)
+        return f"{day_text} {sessions}"
@@ -1,17 +1,25 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 from typing import List, Optional
+from datetime import datetime
 import uvicorn
 import asyncio
 import os
+import uuid
 
-from .database import DB, User, UserHolding, Order, OrderType, OrderStatus, MarketHistory, get_china_time
+from .database import DB, User, OrderType, OrderStatus, get_china_time
 from .market import Market
+from .matching import OrderRejected
+from .aggregation import TIMEFRAMES
+from .events import EventHub
+from .executor import BoundedExecutor, ExecutorBusy
+from .auth import TokenSigner, LoginLimiter
+from .positions import mask_user_id
+from .fixedpoint import INITIAL_BALANCE, to_qty, to_price, from_cash, from_qty, from_price
 
 # Password hashing
 # Use pbkdf2_sha256 to avoid bcrypt 72-byte limit/version issues on Windows
@@ -19,141 +27,354 @@ pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 
 app = FastAPI()
 
+# Failed logins per user id and per client address. Behind a reverse proxy the
+# address comes from X-Forwarded-For, trusted only from web_trusted_proxies
+login_limiter = LoginLimiter(max_failures=5, window=300)
+
+# Push feed for /api/stream, fed by Market listeners
+hub = EventHub()
+# Seconds between keep-alive comments on idle streams
+STREAM_PING_INTERVAL = 15
+
+# Versions restart at 0 with the process, so ETags carry a per-process prefix
+_ETAG_EPOCH = uuid.uuid4().hex[:8]
+
+def _etag(*parts):
+    return 'W/"' + "-".join(str(p) for p in (_ETAG_EPOCH,) + parts) + '"'
+
+def _not_modified(request: Request, etag: str):
+    """304 response if the client already has `etag`, else None"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+def _versioned(content, etag: str):
+    # no-cache: browsers keep the body but revalidate with If-None-Match every time
+    return JSONResponse(content, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
 # Mount static files
 static_path = os.path.join(os.path.dirname(__file__), "web")
 app.mount("/static", StaticFiles(directory=static_path), name="static")
 
-# Dependency
-def get_db():
-    # This is a bit tricky since DB is initialized in main.py
-    # We will inject DB instance into app state
-    db = app.state.db_instance
-    session = db.get_session()
+async def run_blocking(fn, *args, **kwargs):
+    """Await fn(*args, **kwargs) on the web worker threads, 503 when they are saturated"""
     try:
-        yield session
-    finally:
-        session.close()
+        return await app.state.db_executor.run(fn, *args, **kwargs)
+    except ExecutorBusy:
+        raise HTTPException(status_code=503, detail="Server busy, try again later")
+
+async def run_db(fn, *args, read_only=False):
+    """
+    Run fn(session, *args) on the web DB threads with a fresh session and await
+    the result, so no SQLite round trip runs on the event loop (which is AstrBot's).
+    """
+    db: DB = app.state.db_instance
+
+    def job():
+        session = db.get_read_session() if read_only else db.get_session()
+        try:
+            return fn(session, *args)
+        finally:
+            session.close()
+
+    return await run_blocking(job)
+
+def _request_token(request: Request, allow_query=False):
+    auth = request.headers.get("authorization", "")
+    if auth.lower().startswith("bearer "):
+        return auth[7:].strip()
+    # Only for EventSource, which can't send headers; elsewhere it would put tokens in URLs and logs
+    return request.query_params.get("token") if allow_query else None
+
+def optional_user(request: Request) -> Optional[str]:
+    """User id of a valid session token, or None"""
+    token = _request_token(request)
+    return app.state.token_signer.verify(token) if token else None
+
+def stream_user(request: Request) -> Optional[str]:
+    """optional_user() that also accepts ?token=, for /api/stream"""
+    token = _request_token(request, allow_query=True)
+    return app.state.token_signer.verify(token) if token else None
+
+def current_user(request: Request) -> str:
+    """Dependency: user id from the session token (HMAC check only, no DB)"""
+    user_id = optional_user(request)
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Not logged in or session expired",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return user_id
 
 class LoginModel(BaseModel):
     user_id: str
     password: str
 
 class TradeModel(BaseModel):
-    user_id: str
+    # Taken from the session token, a different value here is rejected
+    user_id: Optional[str] = None
     symbol: str
     amount: float
     price: Optional[float] = None
     action: str # "buy" or "sell"
 
 @app.post("/api/login")
-async def login(data: LoginModel, session: Session = Depends(get_db)):
-    user = session.query(User).filter_by(user_id=data.user_id).first()
-    if not user or not user.password_hash:
+async def login(data: LoginModel, request: Request):
+    keys = (f"user:{data.user_id}", f"addr:{request.client.host if request.client else ''}")
+    retry_after = login_limiter.retry_after(*keys)
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Too many failed logins, try again later",
+                            headers={"Retry-After": str(retry_after)})
+
+    def check(session):
+        user = session.query(User).filter_by(user_id=data.user_id).first()
+        if not user or not user.password_hash:
+            return None
+        # pbkdf2 is deliberately slow, keep it off the loop too
+        if not pwd_context.verify(data.password, user.password_hash):
+            return False
+        return {"user_id": user.user_id, "balance": from_cash(user.balance)}
+
+    result = await run_db(check, read_only=True)
+    if result is None:
+        login_limiter.fail(*keys)
         raise HTTPException(status_code=400, detail="User not found or password not set")
-    
-    if not pwd_context.verify(data.password, user.password_hash):
+    if result is False:
+        login_limiter.fail(*keys)
         raise HTTPException(status_code=400, detail="Incorrect password")
-    
-    return {"status": "success", "user_id": user.user_id, "balance": user.balance}
+
+    login_limiter.reset(keys[0])
+    # Later requests carry this token instead of re-sending the password
+    token = app.state.token_signer.issue(result["user_id"])
+    return {"status": "success", "token": token, **result}
 
 @app.get("/api/market")
-async def get_market_data():
+async def get_market_data(request: Request):
     market: Market = app.state.market_instance
+    etag = _etag(market.version, int(market.is_open))
+    cached = _not_modified(request, etag)
+    if cached:
+        return cached
     prices = market.prices
     # Calculate changes (simplified)
     # Ideally reuse logic from main.py /zrb change, but for now just send current prices
-    return {"prices": prices, "is_open": market.is_open}
+    return _versioned({"prices": prices, "is_open": market.is_open, "version": market.version}, etag)
+
+@app.get("/api/status")
+async def get_status():
+    market: Market = app.state.market_instance
+    info = market.get_status_info()
+    next_change = info["next_transition"]
+    return {
+        "is_open": market.is_open,
+        "now": info["now_str"],
+        "status": info["status"],
+        "countdown": info["countdown"],
+        "schedule": info["schedule"],
+        "holidays": [d.isoformat() for d in info["holidays"]],
+        "next_transition": next_change.isoformat() if next_change else None,
+    }
+
+@app.get("/api/change")
+async def get_change():
+    market: Market = app.state.market_instance
+    return {"changes": market.get_changes(), "is_open": market.is_open}
 
 @app.get("/api/assets/{user_id}")
-async def get_assets(user_id: str, session: Session = Depends(get_db)):
-    user = session.query(User).filter_by(user_id=user_id).first()
-    if not user:
+async def get_assets(user_id: str, request: Request, auth_user: str = Depends(current_user)):
+    if user_id != auth_user:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    market: Market = app.state.market_instance
+    # Read the version before the data: a change racing this query only makes the tag older
+    etag = _etag(user_id, market.user_version(user_id))
+    cached = _not_modified(request, etag)
+    if cached:
+        return cached
+
+    # From the position cache; only a miss reads the database
+    account = market.positions.peek(user_id) or await run_blocking(market.positions.get, user_id)
+    if account is None:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    holdings = session.query(UserHolding).filter_by(user_id=user_id).all()
+
     holdings_list = []
-    for h in holdings:
-        if h.amount > 0.0001:
-            holdings_list.append({"symbol": h.symbol, "amount": h.amount})
-            
-    return {"balance": user.balance, "holdings": holdings_list}
+    for sym, (amount, locked, cost) in sorted(account["positions"].items()):
+        if amount + locked > 0:
+            holdings_list.append({"symbol": sym, "amount": from_qty(amount + locked), "reserved": from_qty(locked),
+                                  "avg_cost": round(from_cash(cost) / from_qty(amount + locked), 4)})
+
+    return _versioned({"balance": from_cash(account["balance"]),
+                       "reserved_balance": from_cash(account["reserved_balance"]),
+                       "holdings": holdings_list}, etag)
+
+@app.get("/api/leaderboard")
+async def get_leaderboard(request: Request, limit: int = 10):
+    """Accounts by total equity at the last tick, from memory (active users only, see PositionCache)"""
+    market: Market = app.state.market_instance
+    limit = max(1, min(limit, 100))
+    etag = _etag("leaderboard", market.positions.version, limit)
+    cached = _not_modified(request, etag)
+    if cached:
+        return cached
+    initial = from_cash(INITIAL_BALANCE)
+    board = []
+    for rank, (user_id, account) in enumerate(market.positions.top(limit), 1):
+        equity = from_cash(account["equity"])
+        board.append({"rank": rank, "user": mask_user_id(user_id), "equity": equity,
+                      "return": round(equity / initial - 1, 6)})
+    return _versioned({"leaderboard": board, "users": len(market.positions)}, etag)
 
 @app.post("/api/trade")
-async def trade(data: TradeModel, session: Session = Depends(get_db)):
+async def trade(data: TradeModel, auth_user: str = Depends(current_user)):
+    if data.user_id and data.user_id != auth_user:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    data.user_id = auth_user
     market: Market = app.state.market_instance
     
     if not market.is_open:
          raise HTTPException(status_code=400, detail="Market is closed")
 
-    user = session.query(User).filter_by(user_id=data.user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
     symbol = data.symbol.upper()
     if symbol not in market.symbols:
         raise HTTPException(status_code=400, detail="Invalid symbol")
     
-    if data.amount <= 0:
+    # Ledger units (fixedpoint); amounts below one lot round to zero
+    try:
+        amount = to_qty(data.amount)
+        price = to_price(data.price) if data.price is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid amount or price")
+    if amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
+    if price is not None and price <= 0:
+        raise HTTPException(status_code=400, detail="Price must be positive")
 
-    # Basic Validation
-    if data.action == "buy":
-        est_price = data.price if data.price else market.prices[symbol]
-        cost = est_price * data.amount * 1.001
-        if user.balance < cost:
-            raise HTTPException(status_code=400, detail=f"Insufficient balance. Need {cost:.2f}")
-    elif data.action == "sell":
-        holding = session.query(UserHolding).filter_by(user_id=data.user_id, symbol=symbol).first()
-        if not holding or holding.amount < data.amount:
-             raise HTTPException(status_code=400, detail=f"Insufficient holding")
-    else:
+    if data.action not in ("buy", "sell"):
         raise HTTPException(status_code=400, detail="Invalid action")
 
-    # Create Order
+    # Queued to the matching engine (reserve, insert, match); awaiting the future
+    # holds no worker thread
     order_type = OrderType.BUY if data.action == "buy" else OrderType.SELL
-    order = Order(
-        user_id=data.user_id,
-        symbol=symbol,
-        order_type=order_type,
-        price=data.price,
-        amount=data.amount
-    )
-    session.add(order)
-    session.commit()
-    order_id = order.id
-    
-    # Trigger Match
-    market.match_single_order(order_id)
-    
-    # Check Result
-    session.refresh(order)
+    try:
+        order_id, order_status, exec_price = await asyncio.wrap_future(
+            market.matcher.place(data.user_id, symbol, order_type, amount, price))
+    except OrderRejected as e:
+        if e.reason == "user":
+            raise HTTPException(status_code=404, detail="User not found")
+        if e.reason == "balance":
+            raise HTTPException(status_code=400, detail=f"Insufficient balance. Need {from_cash(e.need):.2f}")
+        raise HTTPException(status_code=400, detail="Insufficient holding")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid amount or price")
+    except Exception as e:
+        # Rolled back by the engine (its own command only) or the engine is stopped
+        logger.error(f"[Zirunbi] Order failed: {e}")
+        raise HTTPException(status_code=503, detail="Order could not be processed, try again later")
     return {
-        "status": "success", 
-        "order_id": order_id, 
-        "order_status": order.status.value,
+        "status": "success",
+        "order_id": order_id,
+        "order_status": order_status.value,
+        "exec_price": exec_price,
         "message": "Order submitted"
     }
 
+@app.get("/api/stream")
+async def stream(request: Request, user_id: Optional[str] = Depends(stream_user)):
+    """
+    Server-Sent Events feed: "prices" on every tick, "candle" when a candle closes
+    and, with a session token (?token=), "fill" for that user's executed orders.
+    """
+    market: Market = app.state.market_instance
+    queue = hub.subscribe(user_id)
+
+    async def events():
+        try:
+            # Snapshot first so the page doesn't wait for the next tick
+            yield hub.encode("prices", {"prices": market.prices, "is_open": market.is_open})
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), STREAM_PING_INTERVAL)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    message = ": ping\n\n"
+                yield message
+        finally:
+            hub.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+def _cursor(timestamp):
+    return timestamp.replace(tzinfo=None).isoformat(sep=' ', timespec='microseconds')
+
+def _bar_json(candle):
+    """
+    Candle in integer units -> JSON bar with plain prices / amounts. `time` is the
+    axis label, `ts` the full-resolution key (candles can be a second apart).
+    """
+    return {
+        "time": candle.timestamp.strftime('%Y-%m-%d %H:%M'),
+        "ts": _cursor(candle.timestamp),
+        "open": from_price(candle.open),
+        "high": from_price(candle.high),
+        "low": from_price(candle.low),
+        "close": from_price(candle.close),
+        "volume": from_qty(candle.volume),
+    }
+
+def _candle_json(candle):
+    return {"symbol": candle.symbol, **_bar_json(candle)}
+
+def _publish_prices(prices):
+    market: Market = app.state.market_instance
+    hub.publish("prices", {"prices": prices, "is_open": market.is_open})
+
+def _publish_candles(candles):
+    for candle in candles.values():
+        if candle is not None:
+            hub.publish("candle", _candle_json(candle))
+
+def _publish_fills(fills):
+    for fill in fills:
+        hub.publish("fill", fill, user_id=fill["user_id"])
+
 @app.get("/api/kline/{symbol}")
-async def get_kline(symbol: str, session: Session = Depends(get_db)):
+async def get_kline(request: Request, symbol: str, interval: str = "raw", limit: int = 100, since: Optional[str] = None):
+    """
+    Candles of `symbol`. `since` is the `cursor` of a previous response: only bars at or
+    after it are returned (raw: strictly after), oldest first, clients merge them by
+    `ts`. `more` is true when the page is full and the client should ask again.
+    """
+    market: Market = app.state.market_instance
     symbol = symbol.upper()
-    # Get last 100 records
-    history = session.query(MarketHistory).filter_by(symbol=symbol).order_by(MarketHistory.timestamp.desc()).limit(100).all()
-    
-    # Reverse to chronological order
-    history = history[::-1]
+    if interval != "raw" and interval not in TIMEFRAMES:
+        raise HTTPException(status_code=400, detail=f"Invalid interval, use raw or one of {list(TIMEFRAMES)}")
+    limit = max(1, min(limit, 1000))
+    since_time = None
+    if since:
+        try:
+            since_time = datetime.fromisoformat(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid since, use the cursor of a previous response")
+    if symbol not in market.symbols:
+        return {"symbol": symbol, "interval": interval, "data": [], "cursor": since, "more": False}
+
+    # Bars only change when a candle of this symbol is saved. The id moves once the
+    # writer has committed it, so a body read from SQLite is never tagged ahead of it
+    etag = _etag(symbol, interval, limit, since or "", market.last_candle_ids.get(symbol, ""))
+    cached = _not_modified(request, etag)
+    if cached:
+        return cached
+
+    # Raw candles come from the in-memory ring buffer, larger intervals are rolled up from them
+    history = await run_blocking(market.get_candles, symbol, interval, limit, since=since_time)
     
-    data = []
-    for h in history:
-        data.append({
-            "time": h.timestamp.strftime('%Y-%m-%d %H:%M'),
-            "open": h.open,
-            "high": h.high,
-            "low": h.low,
-            "close": h.close,
-            "volume": h.volume
-        })
-    return {"symbol": symbol, "data": data}
+    data = [_bar_json(h) for h in history]
+    cursor = _cursor(history[-1].timestamp) if history else since
+    more = since_time is not None and len(history) == limit
+    return _versioned({"symbol": symbol, "interval": interval, "data": data, "cursor": cursor,
+                       "more": more}, etag)
 
 @app.get("/")
 async def index():
@@ -162,19 +383,30 @@ async def index():
 
 import socket
 import logging
+import threading
 
 logger = logging.getLogger("astrbot")
 
 class WebServer:
-    def __init__(self, db: DB, market: Market, host="0.0.0.0", port=8000):
-        self.config = uvicorn.Config(app, host=host, port=port, log_level="warning")
+    def __init__(self, db: DB, market: Market, host="0.0.0.0", port=8000, db_threads=4, token_secret=None,
+                 trusted_proxies="127.0.0.1"):
+        self.config = uvicorn.Config(app, host=host, port=port, log_level="warning",
+                                     proxy_headers=True, forwarded_allow_ips=trusted_proxies)
         self.server = uvicorn.Server(self.config)
         self.host = host
         self.port = port
+        self.thread = None
         
         # Inject instances
         app.state.db_instance = db
         app.state.market_instance = market
+        # Threads for blocking DB work of the routes, see run_db()
+        self.db_executor = BoundedExecutor(max_workers=db_threads, max_pending=db_threads * 16, name="zrb-web-db")
+        app.state.db_executor = self.db_executor
+        app.state.token_signer = TokenSigner(token_secret)
+        market.add_listener("prices", _publish_prices)
+        market.add_listener("candles", _publish_candles)
+        market.add_listener("fills", _publish_fills)
 
     def is_port_in_use(self) -> bool:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -191,6 +423,7 @@ class WebServer:
             logger.error(f"[Zirunbi] Please change 'web_port' in plugin config or close the application using this port.")
             return
 
+        hub.bind(asyncio.get_running_loop())
         try:
             await self.server.serve()
         except BaseException as e:
@@ -202,7 +435,17 @@ class WebServer:
 
     async def stop(self):
         self.server.should_exit = True
+        if self.thread is not None:
+            # uvicorn notices should_exit within its 0.1s tick, then finishes open requests
+            await asyncio.to_thread(self.thread.join, 10)
+        self.db_executor.shutdown()
     
     def run_in_background(self):
+        """Serve on the caller's (AstrBot's) event loop"""
         loop = asyncio.get_event_loop()
         loop.create_task(self.start())
+
+    def run_in_thread(self):
+        """Serve on a dedicated thread with its own event loop, isolated from the bot's"""
+        self.thread = threading.Thread(target=asyncio.run, args=(self.start(),), name="zrb-web", daemon=True)
+        self.thread.start()